@@ -0,0 +1,169 @@
+import os,sys
+import gc
+import json
+import time
+import platform
+import tracemalloc
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+
+import prologix
+from prologix_sim import Prologix_Simulator, Fake_Instrument, binary_block
+
+# benchmarks of the prologix module against the local simulator of prologix_sim. The results are
+# written as json so that the runs can be compared over time:
+#
+#     python benchmarks/bench_prologix.py -o results.json
+#     python benchmarks/bench_prologix.py --transport pty --latency 0.001 -o results_pty.json
+
+#-----------------------------------------------------------------------------------------------------------
+def percentiles(values,ps=(50,90,99)):
+    values = sorted(values)
+    res = {}
+    for p in ps:
+        res["p%d" % p] = values[min(len(values)-1,int(len(values)*p/100.))]
+    res["mean"] = sum(values)/len(values)
+    res["max"] = values[-1]
+    return res
+
+#-----------------------------------------------------------------------------------------------------------
+def make_simulator(latency,reply_size):
+    sim = Prologix_Simulator()
+    sim.add_instrument(12,Fake_Instrument({"*IDN?" : "BENCH,DMM,0,1.0",
+                                           "READ?" : "+1.234567E+00"},
+                                          latency=latency))
+    sim.add_instrument(5,Fake_Instrument({"CURV?" : binary_block(b"\x55"*reply_size),
+                                          "DATA?" : b"1.0,"*(reply_size//4)},
+                                         latency=latency))
+    return sim
+
+#-----------------------------------------------------------------------------------------------------------
+def open_device(sim,transport):
+    if transport == "tcp":
+        p = prologix.Prologix_Device(dev="tcp",ip="127.0.0.1",port=sim.serve_tcp())
+    else:
+        p = prologix.Prologix_Device(dev="usb",serial_port=sim.serve_pty())
+    p.config()
+    return p
+
+#-----------------------------------------------------------------------------------------------------------
+def bench_latency(p,n):
+    dmm = p.instrument(12)
+    dmm.query("READ?")
+    times = []
+    for i in range(n):
+        t = time.perf_counter()
+        dmm.query("READ?")
+        times.append(time.perf_counter()-t)
+    return percentiles(times)
+
+#-----------------------------------------------------------------------------------------------------------
+def bench_throughput(p,n,batch_size):
+    dmm = p.instrument(12)
+    t = time.perf_counter()
+    for i in range(n):
+        dmm.query("READ?")
+    single = n/(time.perf_counter()-t)
+
+    t = time.perf_counter()
+    dmm.query_many(["READ?"]*n,batch_size=batch_size)
+    batched = n/(time.perf_counter()-t)
+    return {"single_qps" : single, "batched_qps" : batched, "batch_size" : batch_size}
+
+#-----------------------------------------------------------------------------------------------------------
+def bench_scan(p):
+    t = time.perf_counter()
+    found = p.scan_gpib_addresses(verbose=False)
+    return {"seconds" : time.perf_counter()-t, "found" : len(found)}
+
+#-----------------------------------------------------------------------------------------------------------
+def bench_large_reply(p,n,reply_size):
+    scope = p.instrument(5)
+    res = {"reply_size" : reply_size}
+
+    t = time.perf_counter()
+    for i in range(n):
+        scope.query_binary("CURV?")
+    res["binary_MBps"] = n*reply_size/(time.perf_counter()-t)/1e6
+
+    t = time.perf_counter()
+    for i in range(n):
+        scope.query("DATA?")
+    res["text_MBps"] = n*reply_size/(time.perf_counter()-t)/1e6
+    return res
+
+#-----------------------------------------------------------------------------------------------------------
+def bench_cpu(n):
+    """
+    cpu time and allocations of the python side of send() and check_command(), the transport is
+    replaced by a function that does nothing
+    """
+    p = prologix.Prologix_Device(dev="dummy")
+    p._write = lambda msg: None
+    res = {}
+    for name,call in (("send",lambda: p.send("++addr 12;READ?")),
+                      ("check_command",lambda: p.check_command(b"++read_tmo_ms 500"))):
+        call()
+        gc.collect()
+        t = time.process_time()
+        for i in range(n):
+            call()
+        res["%s_us" % name] = (time.process_time()-t)/n*1e6
+
+        # peak of the memory allocated during a call and not freed yet
+        tracemalloc.start()
+        for i in range(1000):
+            call()
+        current,peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        res["%s_peak_bytes" % name] = peak
+    return res
+
+#-----------------------------------------------------------------------------------------------------------
+def git_commit():
+    try:
+        import subprocess
+        return subprocess.check_output(["git","rev-parse","HEAD"],cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+#===========================================================================================================
+
+
+if __name__=="__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="benchmarks of the prologix module against the simulator")
+    parser.add_argument("--transport",choices=["tcp","pty"],default="tcp")
+    parser.add_argument("-n","--n_queries",help="number of queries per measure",type=int,default=1000)
+    parser.add_argument("--batch_size",help="queries per write with query_many",type=int,default=16)
+    parser.add_argument("--latency",help="latency of the fake instruments in seconds",type=float,default=0.)
+    parser.add_argument("--reply_size",help="size of the large replies in bytes",type=int,default=1<<18)
+    parser.add_argument("--skip_scan",help="do not measure the bus scan",action="store_true")
+    parser.add_argument("-o","--output",help="json file for the results",default="bench_results.json")
+    args = parser.parse_args()
+
+    sim = make_simulator(args.latency,args.reply_size)
+    p = open_device(sim,args.transport)
+
+    results = {"timestamp" : time.time(),
+               "commit" : git_commit(),
+               "python" : platform.python_version(),
+               "platform" : platform.platform(),
+               "parameters" : vars(args)}
+
+    results["latency_s"] = bench_latency(p,args.n_queries)
+    results["throughput"] = bench_throughput(p,args.n_queries,args.batch_size)
+    if not args.skip_scan:
+        results["scan"] = bench_scan(p)
+    results["large_reply"] = bench_large_reply(p,max(1,args.n_queries//100),args.reply_size)
+    results["cpu"] = bench_cpu(args.n_queries*10)
+
+    p.close()
+    sim.stop()
+
+    with open(args.output,"w") as f:
+        json.dump(results,f,indent=2)
+    print(json.dumps(results,indent=2))
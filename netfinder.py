@@ -0,0 +1,504 @@
+import sys
+import time
+import random
+import socket
+import struct
+import asyncio
+import logging
+import functools
+import collections
+
+
+NETFINDER_SERVER_PORT  = 3040
+
+NF_IDENTIFY                     =  0
+NF_IDENTIFY_REPLY               =  1
+NF_ASSIGNMENT                   =  2
+NF_ASSIGNMENT_REPLY             =  3
+NF_FLASH_ERASE                  =  4
+NF_FLASH_ERASE_REPLY            =  5
+NF_BLOCK_SIZE                   =  6
+NF_BLOCK_SIZE_REPLY             =  7
+NF_BLOCK_WRITE                  =  8
+NF_BLOCK_WRITE_REPLY            =  9
+NF_VERIFY                       = 10
+NF_VERIFY_REPLY                 = 11
+NF_REBOOT                       = 12
+NF_SET_ETHERNET_ADDRESS         = 13
+NF_SET_ETHERNET_ADDRESS_REPLY   = 14
+NF_TEST                         = 15
+NF_TEST_REPLY                   = 16
+
+NF_SUCCESS                      = 0
+NF_CRC_MISMATCH                 = 1
+NF_INVALID_MEMORY_TYPE          = 2
+NF_INVALID_SIZE                 = 3
+NF_INVALID_IP_TYPE              = 4
+
+NF_MAGIC                        = 0x5A
+
+NF_IP_DYNAMIC                   = 0
+NF_IP_STATIC                    = 1
+
+NF_ALERT_OK                     = 0x00
+NF_ALERT_WARN                   = 0x01
+NF_ALERT_ERROR                  = 0xFF
+
+NF_MODE_BOOTLOADER              = 0
+NF_MODE_APPLICATION             = 1
+
+NF_MEMORY_FLASH                 = 0
+NF_MEMORY_EEPROM                = 1
+
+NF_REBOOT_CALL_BOOTLOADER       = 0
+NF_REBOOT_RESET                 = 1
+
+
+HEADER_FMT                      = "!2cH6s2x"
+IDENTIFY_FMT                    = HEADER_FMT
+IDENTIFY_REPLY_FMT              = "!H6c4s4s4s4s4s4s32s"
+ASSIGNMENT_FMT                  = "!3xc4s4s4s32x"
+ASSIGNMENT_REPLY_FMT            = "!c3x"
+FLASH_ERASE_FMT                 = HEADER_FMT
+FLASH_ERASE_REPLY_FMT           = HEADER_FMT
+BLOCK_SIZE_FMT                  = HEADER_FMT
+BLOCK_SIZE_REPLY_FMT            = "!H2x"
+BLOCK_WRITE_FMT                 = "!cxHI"
+BLOCK_WRITE_REPLY_FMT           = "!c3x"
+VERIFY_FMT                      = HEADER_FMT
+VERIFY_REPLY_FMT                = "!c3x"
+REBOOT_FMT                      = "!c3x"
+SET_ETHERNET_ADDRESS_FMT        = "!6s2x"
+SET_ETHERNET_ADDRESS_REPLY_FMT  = HEADER_FMT
+TEST_FMT                        = HEADER_FMT
+TEST_REPLY_FMT                  = "!32s"
+
+MAX_ATTEMPTS                    = 10
+MAX_TIMEOUT                     = 0.5
+
+DISCOVERY_ATTEMPTS              = 3     # identify broadcasts per discovery, against the lost datagrams
+FLEET_INTERVAL                  = 5.    # seconds between the identify rounds of Fleet_Monitor
+FLEET_MISSED_ROUNDS             = 3     # rounds without reply after which a controller has disappeared
+FLEET_RCVBUF                    = 1<<20 # receive buffer of the socket of Fleet_Monitor
+
+# the codecs are compiled once. The identify reply is decoded in one go with the bytes as integers.
+HEADER_STRUCT                   = struct.Struct(HEADER_FMT)
+IDENTIFY_REPLY_STRUCT           = struct.Struct(HEADER_FMT + IDENTIFY_REPLY_FMT[1:])
+IDENTIFY_REPLY_FAST             = struct.Struct("!BBH6s2xHBBBBBB4s4s4s4s4s4s32s")
+
+# discovery of the Prologix GPIB-ETHERNET controllers (and the other NetFinder devices) of the local
+# networks. An identify request is broadcast on every interface and all the replies carrying its
+# sequence number are collected until the deadline:
+#
+#     for c in find_controllers():
+#         p = Prologix_Device(dev="tcp", ip=c["ip"])
+#
+#     controllers = await discover(timeout=1.)
+#     pool = Prologix_Pool([pool_entry(c) for c in controllers])
+#
+#     python netfinder.py
+#-----------------------------------------------------------------------------
+def MkHeader(id, seq, eth_addr):
+    return HEADER_STRUCT.pack(
+        bytes([NF_MAGIC]),
+        bytes([id]),
+        seq,
+        bytes(eth_addr,"latin-1")
+        );    
+#-----------------------------------------------------------------------------
+def MkIdentify(seq):
+    return MkHeader(NF_IDENTIFY, seq, '\xFF\xFF\xFF\xFF\xFF\xFF')
+
+#-----------------------------------------------------------------------------
+def UnMkIdentifyReply(msg):
+    params = IDENTIFY_REPLY_STRUCT.unpack_from(msg)
+    d = {}
+    d['magic'] = ord(params[0])
+    d['id'] = ord(params[1])
+    d['sequence'] = params[2]
+    d['eth_addr'] = params[3]
+    params = params[4:]
+
+    d['uptime_days'] = params[0]
+    d['uptime_hrs'] = ord(params[1])
+    d['uptime_min'] = ord(params[2])
+    d['uptime_secs'] = ord(params[3])
+    d['mode'] = ord(params[4])
+    d['alert'] = ord(params[5])
+    d['ip_type'] = ord(params[6])
+    d['ip_addr'] = params[7]
+    d['ip_netmask'] = params[8]
+    d['ip_gw'] = params[9]
+    d['app_ver'] = params[10]
+    d['boot_ver'] = params[11]
+    d['hw_ver'] = params[12]
+    d['name'] = params[13]
+    return d
+
+#-----------------------------------------------------------------------------
+def UnMkHeader(msg):
+    params = HEADER_STRUCT.unpack_from(msg)
+        
+    d = {}
+    d['magic'] = ord(params[0])
+    d['id'] = ord(params[1])
+    d['sequence'] = params[2]
+    d['eth_addr'] = params[3]
+    return d
+#-----------------------------------------------------------------------------
+def FormatEthAddr(a):
+    return ":".join(["%02X" % i for i in a])  
+
+#-----------------------------------------------------------------------------
+def PrintDetails(d):
+
+    print()
+    print("Ethernet Address: %s " %  FormatEthAddr(d['eth_addr']))
+    print("Hardware: %s Bootloader: %s  Application: %s"  %  (socket.inet_ntoa(d['hw_ver']),
+                                                              socket.inet_ntoa(d['boot_ver']),
+                                                              socket.inet_ntoa(d['app_ver'])))
+    #print "Uptime:", d['uptime_days'], 'days', d['uptime_hrs'], 'hours', d['uptime_min'], 'minutes', d['uptime_secs'], 'seconds'
+    #if d['ip_type'] == NF_IP_STATIC:
+    #    print "Static IP"
+    #elif d['ip_type'] == NF_IP_DYNAMIC:
+    #    print "Dynamic IP"
+    #else: 
+    #    print "Unknown IP type"
+    print("IP Address: %s Mask :%s Gateway: %s" % (socket.inet_ntoa(d['ip_addr']),
+                                                   socket.inet_ntoa(d['ip_netmask']),
+                                                   socket.inet_ntoa(d['ip_gw'])))
+    #print "Mode:",
+    #if d['mode'] == NF_MODE_BOOTLOADER:
+    #    print 'Bootloader'
+    #elif d['mode'] == NF_MODE_APPLICATION:
+    #    print 'Application'
+    #else:
+    #    print 'Unknown'
+
+#-----------------------------------------------------------------------------
+def IdentifyRecord(d, source=None):
+    """
+    return the record of a controller from the decoded identify reply d: the
+    fields of d with the addresses as strings, its name, its uptime in seconds
+    and the address the reply came from
+    """
+    r = dict(d)
+    r['ip'] = socket.inet_ntoa(d['ip_addr'])
+    r['netmask'] = socket.inet_ntoa(d['ip_netmask'])
+    r['gateway'] = socket.inet_ntoa(d['ip_gw'])
+    r['mac'] = FormatEthAddr(d['eth_addr'])
+    r['name'] = d['name'].split(b"\0", 1)[0].decode(errors="replace")
+    r['uptime'] = ((d['uptime_days']*24 + d['uptime_hrs'])*60 + d['uptime_min'])*60 + d['uptime_secs']
+    r['source'] = source
+    return r
+
+#-----------------------------------------------------------------------------
+def pool_entry(record, **kwargs):
+    """
+    return the Prologix_Pool entry of the controller of record, kwargs are
+    added to the arguments of its Prologix_Device
+    """
+    return dict(name=record['name'] or record['mac'], dev="tcp", ip=record['ip'], **kwargs)
+
+#-----------------------------------------------------------------------------
+def interface_broadcasts():
+    """
+    return the broadcast addresses of the IPv4 interfaces, the limited
+    broadcast 255.255.255.255 being the only one if they can not be listed
+    """
+    broadcasts = ["255.255.255.255"]
+    try:
+        import fcntl
+        SIOCGIFBRDADDR = 0x8919
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for index, name in socket.if_nameindex():
+                try:
+                    req = struct.pack("256s", name.encode()[:15])
+                    addr = socket.inet_ntoa(fcntl.ioctl(s.fileno(), SIOCGIFBRDADDR, req)[20:24])
+                except OSError:
+                    continue
+                if addr != "0.0.0.0" and addr not in broadcasts:
+                    broadcasts.append(addr)
+        finally:
+            s.close()
+    except (ImportError, OSError):
+        pass
+    return broadcasts
+
+#-----------------------------------------------------------------------------
+class _Identify_Protocol(asyncio.DatagramProtocol):
+    def __init__(self, seq):
+        self.seq = seq
+        # mac -> record
+        self.found = {}
+    def datagram_received(self, data, addr):
+        if len(data) < IDENTIFY_REPLY_STRUCT.size:
+            return
+        d = UnMkHeader(data)
+        # our own broadcast comes back on the loopback
+        if d['magic'] != NF_MAGIC or d['id'] != NF_IDENTIFY_REPLY or d['sequence'] != self.seq:
+            return
+        r = IdentifyRecord(UnMkIdentifyReply(data), addr[0])
+        if r['mac'] not in self.found:
+            logging.info("netfinder: %s (%s) at %s" % (r['name'], r['mac'], r['ip']))
+        self.found[r['mac']] = r
+    def error_received(self, exc):
+        logging.debug("netfinder: %s" % exc)
+
+#-----------------------------------------------------------------------------
+async def discover(timeout=MAX_TIMEOUT, broadcasts=None, attempts=DISCOVERY_ATTEMPTS,
+                   port=NETFINDER_SERVER_PORT):
+    """
+    broadcast identify requests on all the interfaces (or to the addresses of
+    broadcasts) and return the records of IdentifyRecord of all the devices
+    that replied before timeout seconds, sorted by ip. The requests are sent
+    attempts times during the first half of the timeout.
+    """
+    loop = asyncio.get_running_loop()
+    if broadcasts is None:
+        broadcasts = interface_broadcasts()
+    seq = random.randint(1, 65535)
+    msg = MkIdentify(seq)
+
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: _Identify_Protocol(seq),
+        local_addr=("0.0.0.0", 0),
+        allow_broadcast=True)
+    try:
+        deadline = loop.time() + timeout
+        for i in range(attempts):
+            for addr in broadcasts:
+                try:
+                    transport.sendto(msg, (addr, port))
+                except OSError as e:
+                    logging.debug("netfinder: can not send to %s: %s" % (addr, e))
+            if i < attempts - 1:
+                await asyncio.sleep(timeout/2./attempts)
+        await asyncio.sleep(max(0., deadline - loop.time()))
+    finally:
+        transport.close()
+    return sorted(protocol.found.values(), key=lambda r: socket.inet_aton(r['ip']))
+
+#-----------------------------------------------------------------------------
+def find_controllers(timeout=MAX_TIMEOUT, **kwargs):
+    """
+    blocking version of discover
+    """
+    return asyncio.run(discover(timeout, **kwargs))
+
+#-----------------------------------------------------------------------------
+# the compact record of a controller kept by Fleet_Monitor
+Controller_Status = collections.namedtuple("Controller_Status",
+                                           "mac ip name uptime alert mode seen")
+
+# an event of Fleet_Monitor: kind is new, reboot, alert, ip_change,
+# disappeared or back, old and new the Controller_Status before and after
+Fleet_Event = collections.namedtuple("Fleet_Event", "kind mac old new time")
+
+#-----------------------------------------------------------------------------
+# the same controllers reply at every round, their texts are converted once
+@functools.lru_cache(maxsize=4096)
+def _mac_text(eth_addr):
+    return eth_addr.hex(":").upper()
+
+@functools.lru_cache(maxsize=4096)
+def _ip_text(ip_addr):
+    return socket.inet_ntoa(ip_addr)
+
+@functools.lru_cache(maxsize=4096)
+def _name_text(name):
+    return name.split(b"\0", 1)[0].decode(errors="replace")
+
+#-----------------------------------------------------------------------------
+def DecodeIdentifyReply(data, seq, now):
+    """
+    return the Controller_Status of the identify reply data to the request of
+    sequence number seq, None for any other datagram
+    """
+    if len(data) < IDENTIFY_REPLY_FAST.size:
+        return None
+    (magic, id, sequence, eth_addr, days, hrs, mins, secs, mode, alert, ip_type,
+     ip_addr, netmask, gw, app_ver, boot_ver, hw_ver, name) = IDENTIFY_REPLY_FAST.unpack_from(data)
+    if magic != NF_MAGIC or id != NF_IDENTIFY_REPLY or sequence != seq:
+        return None
+    return Controller_Status(_mac_text(eth_addr),
+                             _ip_text(ip_addr),
+                             _name_text(name),
+                             ((days*24 + hrs)*60 + mins)*60 + secs,
+                             alert,
+                             mode,
+                             now)
+
+#-----------------------------------------------------------------------------
+class _Fleet_Protocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.seq = None
+        self.round = None
+    def datagram_received(self, data, addr):
+        if self.round is None:
+            return
+        status = DecodeIdentifyReply(data, self.seq, time.time())
+        if status is not None:
+            self.round[status.mac] = status
+
+#-----------------------------------------------------------------------------
+class Fleet_Monitor():
+    """
+    watch the Ethernet controllers with an identify broadcast round every
+    interval seconds. Each round is compared to the last status of every
+    controller and gives Fleet_Event: new, reboot (its uptime went back),
+    alert (its alert flag changed), ip_change, disappeared (no reply during
+    missed rounds) and back. known is the list of the MAC addresses expected,
+    on_event a function called with each event and index a
+    prologix_index.Discovery_Index kept up to date with the ips.
+
+    usage:
+        monitor = Fleet_Monitor(on_event=print)
+        await monitor.run()              # until monitor.stop()
+        events = await monitor.poll()    # or one round at a time
+    """
+    def __init__(self, interval=FLEET_INTERVAL, timeout=MAX_TIMEOUT, broadcasts=None,
+                 missed=FLEET_MISSED_ROUNDS, known=(), on_event=None, index=None,
+                 port=NETFINDER_SERVER_PORT):
+        self.interval = interval
+        self.timeout = timeout
+        self.broadcasts = broadcasts if broadcasts is not None else interface_broadcasts()
+        self.missed = missed
+        self.on_event = on_event
+        self.index = index
+        self.port = port
+        # the MACs are written as in the replies, 00:21:69:01:02:03
+        known = [mac.upper().replace("-", ":") for mac in known]
+        # mac -> last Controller_Status (None for the known ones never seen)
+        self.status = dict([(mac, None) for mac in known])
+        # mac -> number of rounds without reply
+        self.silent = dict([(mac, 0) for mac in known])
+        self.down = set()
+        self._transport = None
+        self._protocol = None
+        self._running = False
+        self._seq = random.randint(1, 65535)
+    #-------------------------------------------------------------------------
+    async def _open(self):
+        loop = asyncio.get_running_loop()
+        self._transport, self._protocol = await loop.create_datagram_endpoint(
+            _Fleet_Protocol, local_addr=("0.0.0.0", 0), allow_broadcast=True)
+        # the replies of the whole fleet arrive at once
+        sock = self._transport.get_extra_info("socket")
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, FLEET_RCVBUF)
+        except OSError:
+            pass
+    #-------------------------------------------------------------------------
+    async def poll(self):
+        """
+        run one identify round and return its events
+        """
+        if self._transport is None:
+            await self._open()
+        self._seq = self._seq % 65535 + 1
+        self._protocol.seq = self._seq
+        self._protocol.round = {}
+        msg = MkIdentify(self._seq)
+        for addr in self.broadcasts:
+            try:
+                self._transport.sendto(msg, (addr, self.port))
+            except OSError as e:
+                logging.debug("netfinder: can not send to %s: %s" % (addr, e))
+        await asyncio.sleep(self.timeout)
+        replies, self._protocol.round = self._protocol.round, None
+        return self._update(replies)
+    #-------------------------------------------------------------------------
+    def _update(self, replies):
+        now = time.time()
+        events = []
+        for mac, new in replies.items():
+            old = self.status.get(mac)
+            self.silent[mac] = 0
+            if old is None:
+                events.append(Fleet_Event("new", mac, None, new, now))
+            else:
+                if mac in self.down:
+                    events.append(Fleet_Event("back", mac, old, new, now))
+                if new.uptime < old.uptime:
+                    events.append(Fleet_Event("reboot", mac, old, new, now))
+                if new.alert != old.alert:
+                    events.append(Fleet_Event("alert", mac, old, new, now))
+                if new.ip != old.ip:
+                    events.append(Fleet_Event("ip_change", mac, old, new, now))
+            self.down.discard(mac)
+            self.status[mac] = new
+
+        for mac in self.status:
+            if mac in replies or mac in self.down:
+                continue
+            self.silent[mac] += 1
+            if self.silent[mac] >= self.missed:
+                self.down.add(mac)
+                events.append(Fleet_Event("disappeared", mac, self.status[mac], None, now))
+
+        if self.index is not None and any([e.kind in ("new", "ip_change") for e in events]):
+            self.index.update_tcp([{"mac" : s.mac, "ip" : s.ip, "name" : s.name}
+                                   for s in replies.values()])
+        if self.on_event is not None:
+            for e in events:
+                self.on_event(e)
+        return events
+    #-------------------------------------------------------------------------
+    async def run(self):
+        """
+        poll every interval seconds until stop()
+        """
+        self._running = True
+        loop = asyncio.get_running_loop()
+        try:
+            while self._running:
+                t = loop.time()
+                await self.poll()
+                await asyncio.sleep(max(0., self.interval - (loop.time() - t)))
+        finally:
+            self.close()
+    #-------------------------------------------------------------------------
+    def stop(self):
+        self._running = False
+    #-------------------------------------------------------------------------
+    def close(self):
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+
+
+if __name__=="__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="find the Prologix GPIB-ETHERNET controllers of the local networks")
+    parser.add_argument("-t", "--timeout", help="time to wait for the replies", type=float, default=MAX_TIMEOUT)
+    parser.add_argument("-b", "--broadcast", help="broadcast addresses (all the interfaces by default)",
+                        nargs="+", default=None)
+    parser.add_argument("-m", "--monitor", help="watch the controllers with a round every this many seconds",
+                        type=float, default=None)
+    args = parser.parse_args()
+
+    if args.monitor is not None:
+        def print_event(e):
+            # a known controller never seen has no status
+            s = e.new or e.old
+            print("%s %-11s %s %-15s %s" % (time.strftime("%H:%M:%S", time.localtime(e.time)),
+                                            e.kind, e.mac, s.ip if s else "-", s.name if s else ""))
+        monitor = Fleet_Monitor(args.monitor, args.timeout, args.broadcast, on_event=print_event)
+        try:
+            asyncio.run(monitor.run())
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    controllers = find_controllers(args.timeout, broadcasts=args.broadcast)
+    for d in controllers:
+        PrintDetails(d)
+    print()
+    print("%d controller(s) found" % len(controllers))
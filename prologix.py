@@ -1,5 +1,13 @@
 import os,sys
+import time
+import socket
 import logging
+import random
+import math
+import bisect
+import functools
+import threading
+import collections
 
 
 dbg_lvl = {
@@ -13,6 +21,40 @@ dbg_lvl = {
 
 logging.basicConfig(level=logging.CRITICAL)
 TIMEOUT=1.  # going below might cause probleme when sending a lot of queries quickly
+PROLOGIX_PORT=1234     # tcp port of the ethernet controllers
+CONNECT_TIMEOUT=3.     # an unreachable ethernet controller fails after this many seconds
+RECONNECT_ATTEMPTS=5   # attempts to reopen a lost tcp connection before giving up
+TCP_RECONNECT_DELAY=0.1        # wait between two reconnection attempts, doubled after each of them
+TCP_MAX_RECONNECT_DELAY=5.
+KEEPALIVE_IDLE=10      # seconds of silence before the first keepalive probe
+KEEPALIVE_INTERVAL=5   # seconds between two keepalive probes
+KEEPALIVE_COUNT=3      # unanswered probes before the connection is declared dead
+SERIAL_TIMEOUT_STEP=0.05 # the timeouts of the serial port are rounded up to this many seconds
+READ_CHUNK_SIZE=4096   # size of the buffer preallocated by each transport for its reads
+MAX_READ_SIZE=1<<20    # a reply without terminator is cut after this many bytes
+SCAN_READ_TMO_MS=50    # read timeout of the controller while scanning the GPIB bus
+SCAN_MARGIN=0.1        # extra host side wait for the reply of a serial poll during a scan
+
+ENCODE_CACHE_SIZE=1024 # number of encoded messages kept by encode_command
+STREAM_RING_SIZE=65536 # samples kept by a Prologix_Stream before its overflow policy applies
+STREAM_BATCH_SIZE=256  # samples delivered at once by Prologix_Stream.batches
+SRQ_POLL_INTERVAL=0.01 # seconds between two checks of the SRQ line by SRQ_Dispatcher
+SRQ_MAX_INTERVAL=1.    # longest wait of SRQ_Dispatcher while SRQ is held by an instrument it can not find
+RQS=0x40               # bit of the status byte set by an instrument requesting service
+ADAPTIVE_MARGIN=1.5        # safety factor of the timeouts learned by Adaptive_Timeouts
+ADAPTIVE_MIN_TIMEOUT=0.01  # bounds of the learned timeouts, in seconds
+ADAPTIVE_MAX_TIMEOUT=3.    # (++read_tmo_ms goes up to 3000)
+ADAPTIVE_MAX_BACKOFF=64    # the timeout of an address is doubled after each missing reply up to this factor
+ADAPTIVE_HOST_MARGIN=0.05  # the host waits this much longer than the controller for the reply
+QUERY_CACHE_SIZE=4096  # replies kept by Query_Cache
+# the queries cached by default, with their time to live in seconds (None until invalidated)
+QUERY_CACHE_RULES={"*IDN?" : None, "*OPT?" : None, "++ver" : None}
+
+# upper bounds in seconds of the buckets of the latency histograms of Prologix_Metrics
+LATENCY_BUCKETS = (0.0001,0.0003,0.001,0.003,0.01,0.03,0.1,0.3,1.,3.)
+
+# the settings of the controller that Prologix_Device keeps in its state cache
+STATE_SETTINGS = ("addr","auto","eoi","eos","eot_enable","eot_char","lon","mode","read_tmo_ms","savecfg","status")
 
 
 help_usage = """
@@ -63,6 +105,74 @@ def to_str(a):
     if type(a) == str:
         return a
     return a.decode()
+
+# the prologix commands, they are recognized by their beginning as in "++addr 12" or "++read_tmo_ms 500"
+PROLOGIX_COMMANDS = (b"++addr", b"++auto", b"++clr", b"++eoi", b"++eos", b"++eot_enable", b"++eot_char",
+                     b"++ifc", b"++loc", b"++lon", b"++mode", b"++read", b"++read_tmo_ms", b"++rst",
+                     b"++savecfg", b"++spoll", b"++srq", b"++status", b"++trg", b"++ver", b"++help")
+
+# prefix table: the two letters after ++ -> the commands starting with them
+COMMAND_PREFIXES = {}
+for c in PROLOGIX_COMMANDS:
+    COMMAND_PREFIXES.setdefault(c[2:4],[]).append(c)
+
+class Unknown_Command(Exception):
+    pass
+
+# the reply was lost with the connection, which is open again for the next requests
+class Reply_Lost(Exception):
+    pass
+
+#-----------------------------------------------------------------------------------------------------------
+def check_command(cmd):
+    """
+    return True for the GPIB commands and the known prologix commands, raise Unknown_Command for
+    the other ones starting with ++
+    """
+    # we try to see if you have a prology command or not. It starts by ++ and should be one of PROLOGIX_COMMANDS
+    if not cmd.startswith(b"++"):
+        return True
+    low = cmd[:16].lower()
+    for c in COMMAND_PREFIXES.get(low[2:4],()):
+        if low.startswith(c):
+            return True
+    raise Unknown_Command("%s unknown !! see the prologix commands with ++help" % repr(cmd))
+
+#-----------------------------------------------------------------------------------------------------------
+@functools.lru_cache(maxsize=ENCODE_CACHE_SIZE)
+def encode_command(msg):
+    """
+    return the frame written to the prologix for the message msg, its commands separated by ; are
+    checked and each one ends with a LF. The frames are cached as the same messages come again
+    and again in the acquisition loops.
+    """
+    s_msg = to_bytes(msg)
+    parts = []
+    for c in s_msg.split(b";"):
+        check_command(c)
+        parts.append(c)
+    parts.append(b"")
+    return b"\n".join(parts)
+
+# the name under which the metrics of a message are kept: its last command without arguments
+def command_key(msg):
+    cmd = to_bytes(msg).rsplit(b";",1)[-1].strip()
+    if cmd.startswith(b"++"):
+        return to_str(cmd.split(None,1)[0].lower())
+    return to_str(cmd.split(None,1)[0].upper()[:32]) if cmd else ""
+
+# the numbers of a reply, a float or the list of the values separated by commas
+def parse_numbers(reply):
+    values = [float(v) for v in to_str(reply).strip().split(",")]
+    if len(values) == 1:
+        return values[0]
+    return values
+
+# the address as written after ++addr or ++spoll: "primary" or "primary secondary"
+def gpib_address(primary,secondary=None):
+    if secondary is None:
+        return "%d" % primary
+    return "%d %d" % (primary,secondary)
     
 # a class for debuging it only provides write and read function
 #===========================================================================================================
@@ -72,19 +182,116 @@ class dummy_device():
     def read(self,n):
         print("Dummy mode : we should read %d bytes " % n)
         return b"dummy!!"
+    def read_until(self,terminator,size=MAX_READ_SIZE,timeout=None):
+        print("Dummy mode : we should read until %s " % repr(terminator))
+        return b"dummy!!"
+    def read_into(self,view,timeout=None):
+        print("Dummy mode : we should read %d bytes " % len(view))
+        return 0
+    def close(self):
+        pass
+
+# base class of the real transports. It implements the framed read on top of the _fill method
+# that each transport provides.
+#===========================================================================================================
+class stream_device():
+    def __init__(self,timeout=TIMEOUT):
+        self.timeout = timeout
+        # bytes received after the last terminator, they belong to the next reply
+        self._pending = bytearray()
+        self._chunk = bytearray(READ_CHUNK_SIZE)
+        self._chunk_view = memoryview(self._chunk)
+#-----------------------------------------------------------------------------------------------------------
+    def _fill(self,timeout,size=READ_CHUNK_SIZE):
+        """
+        wait at most timeout seconds for data and return what is available, at most size bytes
+        (empty on timeout)
+        """
+        raise NotImplementedError
+#-----------------------------------------------------------------------------------------------------------
+    def _fill_into(self,view,timeout):
+        """
+        same as _fill but the data is written in the buffer view, return the number of bytes
+        """
+        data = self._fill(timeout,len(view))
+        view[:len(data)] = data
+        return len(data)
+#-----------------------------------------------------------------------------------------------------------
+    def _pop_pending(self,n):
+        data = bytes(self._pending[:n])
+        del self._pending[:n]
+        return data
+#-----------------------------------------------------------------------------------------------------------
+    def read_until(self,terminator,size=MAX_READ_SIZE,timeout=None):
+        """
+        return the bytes up to and including terminator. If the terminator does not come, return
+        what was received after size bytes or when nothing came during timeout seconds. Bytes
+        received after the terminator are kept for the next read.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.monotonic() + timeout
+        buf = self._pending
+        start = 0
+        while True:
+            if terminator:
+                i = buf.find(terminator,start)
+                if i >= 0:
+                    end = i + len(terminator)
+                    break
+            if len(buf) >= size:
+                end = size
+                break
+            remaining = deadline - time.monotonic()
+            data = self._fill(remaining) if remaining > 0 else b""
+            if not data:
+                end = len(buf)
+                break
+            # the terminator may be split between two chunks
+            start = max(0,len(buf) - len(terminator) + 1) if terminator else 0
+            buf += data
+            # like the read timeout of the controller, the timeout runs from the last bytes received
+            deadline = time.monotonic() + timeout
+        return self._pop_pending(min(end,size))
+#-----------------------------------------------------------------------------------------------------------
+    def read_into(self,view,timeout=None):
+        """
+        fill the writable buffer view with the next bytes received and return their number, which
+        is less than len(view) if nothing came during timeout seconds. The data goes straight from the transport
+        to view without intermediate copies.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.monotonic() + timeout
+        view = memoryview(view).cast("B")
+        n = min(len(self._pending),len(view))
+        if n:
+            view[:n] = self._pending[:n]
+            del self._pending[:n]
+        while n < len(view):
+            remaining = deadline - time.monotonic()
+            k = self._fill_into(view[n:],remaining) if remaining > 0 else 0
+            if k == 0:
+                break
+            n += k
+            deadline = time.monotonic() + timeout
+        return n
 
 #===========================================================================================================
-class serial_device():
-    def __init__(self, serial_number=None, baudrate=9600, timeout=TIMEOUT):
+class serial_device(stream_device):
+    def __init__(self, serial_number=None, baudrate=9600, timeout=TIMEOUT, port=None):
         import serial
+        stream_device.__init__(self,timeout)
         self.serial_info={}
-        if serial_number:
-            port = self.find_serial_dev(serial_number)
+        if serial_number or port:
+            # a port given explicitly (e.g. the pty of prologix_sim) is used as is
+            if port == None:
+                port = self.find_serial_dev(serial_number)
             if port == None:
                 raise Exception("No port found for serial_number %s !!\nABORTING " % serial_number)
-            logging.debug("Debug serial device serial_number %s (port %s)" % (serial_number,port))
-            logging.debug("                    baudrate %s type(%s) " % (baudrate,type(baudrate)))
-            logging.debug("                    timeout %s type(%s)" % (timeout,type(timeout)))
+            logging.debug("Debug serial device serial_number %s (port %s)",serial_number,port)
+            logging.debug("                    baudrate %s type(%s) ",baudrate,type(baudrate))
+            logging.debug("                    timeout %s type(%s)",timeout,type(timeout))
         
         
             self.device = serial.Serial(port,baudrate=baudrate,timeout=timeout)
@@ -117,12 +324,11 @@ class serial_device():
         # 'usb_interface_path',
         # 'vid']
 
-        from serial.tools import list_ports
-        for p in list_ports.comports():
-            if p.serial_number==sn:
-                self.serial_info = p.__dict__
-                return p.device
-        return None
+        # the ports are looked up in the discovery index, they are only enumerated when the
+        # serial number is not there (see prologix_index)
+        from prologix_index import default_index
+        port,self.serial_info = default_index().serial_port(sn)
+        return port
 #-----------------------------------------------------------------------------------------------------------
     def get_serial_info(self):
         return self.serial_info
@@ -136,40 +342,451 @@ class serial_device():
         """
         very rough method to get the /dev/ attached to a serial_number
         """
-        
-        path = "/dev/serial/by-id"
-        for r, d, f in os.walk(path):
-            for i in f:
-                if sn in i and os.path.islink(os.path.join(path,i)):
-                    logging.info("Found device %s for serial number %s" %
-                        (os.path.realpath(os.path.join(path,i)),sn))
-                    
-                    return os.path.realpath(os.path.join(path,i))
-        return None
+        from prologix_index import serial_by_id
+        link = serial_by_id(sn)
+        if link is None:
+            return None
+        logging.info("Found device %s for serial number %s" % (os.path.realpath(link),sn))
+        return os.path.realpath(link)
 #-----------------------------------------------------------------------------------------------------------
     def write(self,msg):
-        logging.debug("SERIAL_DEVICE  RAW WRITE %s" % repr(msg))
+        logging.debug("SERIAL_DEVICE  RAW WRITE %r",msg)
 
         self.device.write(msg)
 #-----------------------------------------------------------------------------------------------------------
     def read(self,n):
-        logging.debug("SERIAL_DEVICE  RAW READ %d" % n)
+        logging.debug("SERIAL_DEVICE  RAW READ %d",n)
+        if self._pending:
+            return self._pop_pending(n)
         return(self.device.read(n))
+#-----------------------------------------------------------------------------------------------------------
+    def close(self):
+        self.device.close()
+#-----------------------------------------------------------------------------------------------------------
+    def _fill(self,timeout,size=READ_CHUNK_SIZE):
+        n = self.device.in_waiting
+        if n:
+            return self.device.read(min(n,size))
+
+        # nothing is waiting: block until the first byte comes then take what followed it.
+        # changing the timeout reconfigures the port (tcsetattr), the rounding keeps it the same
+        # from one read to the next
+        timeout = math.ceil(timeout/SERIAL_TIMEOUT_STEP)*SERIAL_TIMEOUT_STEP
+        if self.device.timeout != timeout:
+            self.device.timeout = timeout
+        data = self.device.read(1)
+        n = self.device.in_waiting
+        if data and n and size > 1:
+            data += self.device.read(min(n,size-1))
+        return data
+#-----------------------------------------------------------------------------------------------------------
+    def _fill_into(self,view,timeout):
+        # same as _fill but the port reads into view
+        n = self.device.in_waiting
+        if n:
+            return self.device.readinto(view[:min(n,len(view))])
+
+        timeout = math.ceil(timeout/SERIAL_TIMEOUT_STEP)*SERIAL_TIMEOUT_STEP
+        if self.device.timeout != timeout:
+            self.device.timeout = timeout
+        k = self.device.readinto(view[:1])
+        n = self.device.in_waiting
+        if k and n and len(view) > 1:
+            k += self.device.readinto(view[1:1+min(n,len(view)-1)])
+        return k
 
 #===========================================================================================================
-class tcp_device():
-    def __init__(self, ip=None, timeout=TIMEOUT):
-        import socket 
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM) 
-        self.sock.connect((ip, 1234))
-        self.sock.settimeout(timeout)
+class tcp_device(stream_device):
+    def __init__(self, ip=None, timeout=TIMEOUT, port=PROLOGIX_PORT, connect_timeout=CONNECT_TIMEOUT,
+                 reconnect_attempts=RECONNECT_ATTEMPTS):
+        stream_device.__init__(self,timeout)
+        self.ip = ip
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.reconnect_attempts = reconnect_attempts
+        # called once reconnected, returns the bytes to send to restore the controller (or b"")
+        self.on_reconnect = None
+        self.sock = None
+        # set by close(), the connection is not opened again after it
+        self.closed = False
+        self.stats = {"connects" : 0,
+                      "reconnects" : 0,
+                      "errors" : 0,
+                      "last_error" : None,
+                      "connected_since" : None,
+                      "bytes_sent" : 0,
+                      "bytes_received" : 0}
+        self.connect()
+#-----------------------------------------------------------------------------------------------------------
+    def connect(self):
+        sock = socket.create_connection((self.ip,self.port),self.connect_timeout)
+        # the commands are small and a reply is awaited after each of them: no Nagle delay
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for opt,value in (("TCP_KEEPIDLE",KEEPALIVE_IDLE),
+                          ("TCP_KEEPINTVL",KEEPALIVE_INTERVAL),
+                          ("TCP_KEEPCNT",KEEPALIVE_COUNT)):
+            if hasattr(socket,opt):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket,opt), value)
+        sock.settimeout(self.timeout)
+        self.sock = sock
+        # what was received on the old connection does not belong to any request anymore
+        self._pending = bytearray()
+        self.stats["connects"] += 1
+        self.stats["connected_since"] = time.time()
+#-----------------------------------------------------------------------------------------------------------
+    def reconnect(self,error):
+        """
+        close the connection after the error and open it again, waiting a bit longer (with some
+        jitter so that many clients do not retry together) after each failed attempt
+        """
+        logging.warning("connection to %s:%d lost (%s), reconnecting",self.ip,self.port,error)
+        self.stats["errors"] += 1
+        self.stats["last_error"] = repr(error)
+        self._drop()
+
+        delay = TCP_RECONNECT_DELAY
+        for attempt in range(self.reconnect_attempts):
+            self._check_open()
+            if attempt:
+                time.sleep(delay*(0.5+random.random()))
+                delay = min(2*delay,TCP_MAX_RECONNECT_DELAY)
+            try:
+                self.connect()
+            except OSError as e:
+                logging.warning("reconnection to %s:%d failed: %s",self.ip,self.port,e)
+                self.stats["last_error"] = repr(e)
+                continue
+            self.stats["reconnects"] += 1
+            if self.on_reconnect is not None:
+                self.sock.sendall(self.on_reconnect())
+            return
+        raise ConnectionError("cannot reconnect to %s:%d: %s" % (self.ip,self.port,self.stats["last_error"]))
+#-----------------------------------------------------------------------------------------------------------
+    def health(self):
+        """
+        return the connection statistics
+        """
+        health = dict(self.stats)
+        health["connected"] = self.sock is not None
+        if self.sock is not None:
+            health["uptime"] = time.time() - self.stats["connected_since"]
+        return health
+#-----------------------------------------------------------------------------------------------------------
+    def _check_open(self):
+        if self.closed:
+            raise ConnectionError("connection to %s:%d closed" % (self.ip,self.port))
 #-----------------------------------------------------------------------------------------------------------
     def write(self,msg):
-        self.sock.sendall(msg)
+        self._check_open()
+        try:
+            self.sock.sendall(msg)
+        except (OSError,AttributeError) as e:
+            self.reconnect(e)
+            self.sock.sendall(msg)
+        self.stats["bytes_sent"] += len(msg)
 #-----------------------------------------------------------------------------------------------------------
     def read(self,n):        
+        if self._pending:
+            return self._pop_pending(n)
+        self._check_open()
         return(self.sock.recv(n))
+#-----------------------------------------------------------------------------------------------------------
+    def _drop(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+#-----------------------------------------------------------------------------------------------------------
+    def close(self):
+        self.closed = True
+        self._drop()
+#-----------------------------------------------------------------------------------------------------------
+    def _fill(self,timeout,size=READ_CHUNK_SIZE):
+        n = self._fill_into(self._chunk_view[:size],timeout)
+        return self._chunk_view[:n]
+#-----------------------------------------------------------------------------------------------------------
+    def _fill_into(self,view,timeout):
+        self._check_open()
+        try:
+            self.sock.settimeout(timeout)
+            n = self.sock.recv_into(view)
+        except socket.timeout:
+            return 0
+        except (OSError,AttributeError) as e:
+            n = 0
+            error = e
+        else:
+            error = ConnectionError("connection closed by the controller")
+        if n == 0:
+            # the reply is lost with the connection, the next requests go to the new one
+            self.reconnect(error)
+            raise Reply_Lost("connection to %s:%d lost during a read" % (self.ip,self.port))
+        self.stats["bytes_received"] += n
+        return n
         
+# timeouts learned per GPIB address from the response times of the instruments. As for the
+# retransmission timeout of TCP, a smoothed response time and its mean deviation are kept and the
+# timeout is margin*(srtt + 4*rttvar), doubled after each missing reply until the next one comes.
+# An override fixes the timeout of an address. The statistics can be saved to a json file and
+# loaded in the next session.
+#===========================================================================================================
+class Adaptive_Timeouts():
+    def __init__(self,margin=ADAPTIVE_MARGIN,min_timeout=ADAPTIVE_MIN_TIMEOUT,max_timeout=ADAPTIVE_MAX_TIMEOUT,
+                 default=TIMEOUT,path=None):
+        self.margin = margin
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.default = default
+        self.path = path
+        # address -> [srtt, rttvar, number of replies]
+        self.stats = {}
+        # address -> timeout
+        self.overrides = {}
+        # address -> factor applied after missing replies
+        self.backoff = {}
+        if path is not None and os.path.exists(path):
+            self.load(path)
+#-----------------------------------------------------------------------------------------------------------
+    def set_override(self,address,timeout):
+        """
+        fix the timeout of address (as in ++addr, "12" or "12 96"), None goes back to the learned one
+        """
+        # the addresses are the strings of ++addr, as the keys of the json file
+        address = str(address)
+        if timeout is None:
+            self.overrides.pop(address,None)
+        else:
+            self.overrides[address] = timeout
+#-----------------------------------------------------------------------------------------------------------
+    def timeout(self,address):
+        """
+        return the timeout in seconds for a reply of the instrument at address
+        """
+        if address in self.overrides:
+            return self.overrides[address]
+        stats = self.stats.get(address)
+        if stats is None:
+            return self.default
+        timeout = self.margin*(stats[0] + 4*stats[1])*self.backoff.get(address,1)
+        return min(self.max_timeout,max(self.min_timeout,timeout))
+#-----------------------------------------------------------------------------------------------------------
+    def record(self,address,duration):
+        """
+        add the response time of a reply of address, None for a missing reply. Nothing is learned
+        without an address, the replies of the controller itself are not the ones of an instrument.
+        """
+        if address is None:
+            return
+        if duration is None:
+            if address in self.stats:
+                self.backoff[address] = min(2*self.backoff.get(address,1),ADAPTIVE_MAX_BACKOFF)
+            return
+        self.backoff.pop(address,None)
+        stats = self.stats.get(address)
+        if stats is None:
+            self.stats[address] = [duration,duration/2.,1]
+            return
+        stats[1] = 0.75*stats[1] + 0.25*abs(stats[0]-duration)
+        stats[0] = 0.875*stats[0] + 0.125*duration
+        stats[2] += 1
+#-----------------------------------------------------------------------------------------------------------
+    def save(self,path=None):
+        import json
+        with open(path or self.path,"w") as f:
+            json.dump({"stats" : self.stats, "overrides" : self.overrides},f,indent=1)
+#-----------------------------------------------------------------------------------------------------------
+    def load(self,path=None):
+        import json
+        with open(path or self.path) as f:
+            d = json.load(f)
+        self.stats.update(d.get("stats",{}))
+        self.overrides.update(d.get("overrides",{}))
+
+# the command as a key of Query_Cache: the ++ commands in lower case, the others in upper case
+def cache_command(cmd):
+    cmd = to_bytes(cmd).strip()
+    if cmd.startswith(b"++"):
+        return cmd.lower()
+    return cmd.upper()
+
+# a cache of the replies to the queries that do not change the instruments and whose reply does not
+# change either (*IDN?, ranges, calibration constants...), keyed by controller, GPIB address and
+# command. Only the commands of rules are cached, each with its time to live in seconds (None for
+# no limit) and the least recently used replies are dropped beyond max_entries. The replies of an
+# address are dropped when a command which is not a query is sent to it or on ++clr, all the replies
+# of a controller on ++rst, ++ifc or a change of the end of the replies (++eot_enable, ++eot_char).
+#===========================================================================================================
+class Query_Cache():
+    def __init__(self,rules=None,max_entries=QUERY_CACHE_SIZE):
+        self.rules = {}
+        for cmd,ttl in (rules if rules is not None else QUERY_CACHE_RULES).items():
+            self.rules[cache_command(cmd)] = ttl
+        self.max_entries = max_entries
+        # (controller, address, command) -> (expiry time or None, reply), the most recent last
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+#-----------------------------------------------------------------------------------------------------------
+    def cacheable(self,cmd):
+        return cache_command(cmd) in self.rules
+#-----------------------------------------------------------------------------------------------------------
+    def get(self,controller,address,cmd):
+        """
+        return the cached reply to cmd or None
+        """
+        key = (controller,address,cache_command(cmd))
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] < time.monotonic():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+#-----------------------------------------------------------------------------------------------------------
+    def put(self,controller,address,cmd,reply):
+        cmd = cache_command(cmd)
+        if cmd not in self.rules:
+            return
+        ttl = self.rules[cmd]
+        with self._lock:
+            self.entries[(controller,address,cmd)] = (time.monotonic() + ttl if ttl is not None else None,reply)
+            self.entries.move_to_end((controller,address,cmd))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+#-----------------------------------------------------------------------------------------------------------
+    def invalidate(self,controller,address=None):
+        """
+        drop the replies of the instrument at address of controller, all of them if address is None
+        """
+        with self._lock:
+            for key in [k for k in self.entries if k[0] == controller and (address is None or k[1] == address)]:
+                del self.entries[key]
+#-----------------------------------------------------------------------------------------------------------
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+# metrics of the traffic of a Prologix_Device, per command and GPIB address. They are plain counters
+# and fixed bucket histograms updated by the device (from one thread at a time, like the device).
+#===========================================================================================================
+class command_stats():
+    __slots__ = ("writes","reads","bytes_out","bytes_in","timeouts","errors","retries",
+                 "write_hist","write_sum","read_hist","read_sum")
+
+    def __init__(self,n_buckets):
+        self.writes = 0
+        self.reads = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.timeouts = 0
+        self.errors = 0
+        # the connection was lost and opened again by the transport during the command
+        self.retries = 0
+        # one count per bucket of LATENCY_BUCKETS plus one for the slower ones
+        self.write_hist = [0]*(n_buckets+1)
+        self.write_sum = 0.
+        self.read_hist = [0]*(n_buckets+1)
+        self.read_sum = 0.
+#-----------------------------------------------------------------------------------------------------------
+    def as_dict(self):
+        return dict([(k,getattr(self,k)) for k in self.__slots__])
+
+#===========================================================================================================
+class Prologix_Metrics():
+    def __init__(self,buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # (command, address) -> command_stats
+        self.stats = {}
+        self.started = time.time()
+#-----------------------------------------------------------------------------------------------------------
+    def _get(self,cmd,address):
+        key = (command_key(cmd),address)
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = command_stats(len(self.buckets))
+        return stats
+#-----------------------------------------------------------------------------------------------------------
+    def record_write(self,cmd,address,n_bytes,duration):
+        stats = self._get(cmd,address)
+        stats.writes += 1
+        stats.bytes_out += n_bytes
+        stats.write_hist[bisect.bisect_left(self.buckets,duration)] += 1
+        stats.write_sum += duration
+#-----------------------------------------------------------------------------------------------------------
+    def record_read(self,cmd,address,n_bytes,duration):
+        stats = self._get(cmd,address)
+        stats.reads += 1
+        stats.bytes_in += n_bytes
+        if n_bytes == 0:
+            stats.timeouts += 1
+        stats.read_hist[bisect.bisect_left(self.buckets,duration)] += 1
+        stats.read_sum += duration
+#-----------------------------------------------------------------------------------------------------------
+    def record_error(self,cmd,address):
+        self._get(cmd,address).errors += 1
+#-----------------------------------------------------------------------------------------------------------
+    def record_retry(self,cmd,address):
+        self._get(cmd,address).retries += 1
+#-----------------------------------------------------------------------------------------------------------
+    def reset(self):
+        self.stats = {}
+        self.started = time.time()
+#-----------------------------------------------------------------------------------------------------------
+    def snapshot(self):
+        """
+        return the metrics as a dict {"started" : time, "buckets" : upper bounds of the
+        histogram buckets, "commands" : [dict of the counters with command and address]}
+        """
+        commands = []
+        for (cmd,address),stats in list(self.stats.items()):
+            d = stats.as_dict()
+            d["command"] = cmd
+            d["address"] = address
+            commands.append(d)
+        return {"started" : self.started, "buckets" : list(self.buckets), "commands" : commands}
+#-----------------------------------------------------------------------------------------------------------
+    def prometheus(self,prefix="prologix",labels=None):
+        """
+        return the metrics in the text format of Prometheus. labels is a dict of labels added to
+        every metric (the name of the controller for instance)
+        """
+        def escape(v):
+            return str(v).replace("\\","\\\\").replace('"','\\"').replace("\n","\\n")
+
+        lines = []
+        items = list(self.stats.items())
+        for name,attr,kind in (("writes_total","writes","counter"),
+                               ("reads_total","reads","counter"),
+                               ("bytes_sent_total","bytes_out","counter"),
+                               ("bytes_received_total","bytes_in","counter"),
+                               ("timeouts_total","timeouts","counter"),
+                               ("errors_total","errors","counter"),
+                               ("retries_total","retries","counter")):
+            lines.append("# TYPE %s_%s %s" % (prefix,name,kind))
+            for (cmd,address),stats in items:
+                lab = dict(labels or {},command=cmd,address=address if address is not None else "")
+                lines.append("%s_%s{%s} %d" % (prefix,name,",".join(['%s="%s"' % (k,escape(v)) for k,v in lab.items()]),
+                                               getattr(stats,attr)))
+
+        for name,hist,total,count in (("write_seconds","write_hist","write_sum","writes"),
+                                      ("read_seconds","read_hist","read_sum","reads")):
+            lines.append("# TYPE %s_%s histogram" % (prefix,name))
+            for (cmd,address),stats in items:
+                lab = dict(labels or {},command=cmd,address=address if address is not None else "")
+                lab = ",".join(['%s="%s"' % (k,escape(v)) for k,v in lab.items()])
+                cumulated = 0
+                for le,n in zip(list(self.buckets)+["+Inf"],getattr(stats,hist)):
+                    cumulated += n
+                    lines.append('%s_%s_bucket{%s,le="%s"} %d' % (prefix,name,lab,le,cumulated))
+                lines.append("%s_%s_sum{%s} %g" % (prefix,name,lab,getattr(stats,total)))
+                lines.append("%s_%s_count{%s} %d" % (prefix,name,lab,getattr(stats,count)))
+        return "\n".join(lines) + "\n"
+
 # the class to talk to the prologix
 #===========================================================================================================
 class Prologix_Device():
@@ -181,7 +798,12 @@ class Prologix_Device():
                  baudrate=9600,
                  timeout=TIMEOUT,
                  gpib_eot="\r\n",
-                 debug_level="critical"):
+                 debug_level="critical",
+                 port=PROLOGIX_PORT,
+                 serial_port=None,
+                 record=None,
+                 replay=None,
+                 speed=None):
 
         self.IS_USB = False
         self.IS_TCP = False
@@ -194,52 +816,205 @@ class Prologix_Device():
                                                                                  ", ".join(dbg_lvl.keys())))
 
         if dev.lower() == "usb":
-            device = serial_device(serial_number,baudrate,timeout)
+            device = serial_device(serial_number,baudrate,timeout,serial_port)
             self.serial_info = device.get_serial_info()
             self.IS_USB = True
 
         elif dev.lower() == "tcp":
-            device = tcp_device(ip,timeout)
+            device = tcp_device(ip,timeout,port)
             self.IS_TCP = True
             
         elif dev.lower() == "dummy":
             device = dummy_device()
+
+        elif dev.lower() == "replay":
+            # the session recorded in the log replay, see prologix_record
+            from prologix_record import replay_device
+            device = replay_device(replay,speed,timeout)
         else:
-            raise Exception("device can only be of type usb, tcp or dummy but %s found" % dev)
+            raise Exception("device can only be of type usb, tcp, dummy or replay but %s found" % dev)
+
+        if self.IS_TCP:
+            device.on_reconnect = self._reconnected
+        if record is not None:
+            # the exchanges with the transport are appended to the log record
+            from prologix_record import recording_device
+            device = recording_device(device,record)
 
         self._write = device.write
         self._read = device.read
+        self._read_until = device.read_until
+        self._read_into = device.read_into
+        self.close = device.close
+        self.device = device
 
         self.gpib_eot = to_bytes(gpib_eot)
+        # end of the replies of the instruments, set by config() from eot_enable/eot_char
+        self.read_terminator = b"\n"
+        self.auto = 0
+        # the settings of the controller as far as we know them, see STATE_SETTINGS
+        self.state = {}
+        # Prologix_Metrics set by enable_metrics, and the command the next reply belongs to
+        self.metrics = None
+        self._last_cmd = b""
+        # Adaptive_Timeouts set by enable_adaptive_timeouts
+        self.timeouts = None
+        # Query_Cache set by enable_cache and the name of the controller in it
+        self.cache = None
+        self.cache_name = None
 
 #-----------------------------------------------------------------------------------------------------------
     def config(self,mode=1,auto=0,eoi=1,eos=1,eot_enable=0,eot_char=10):
         # see https://github.com/rambo/python-scpi/blob/master/scpi/transports/gpib/prologix.py for some values
-        self.send("++mode %d" % mode)
-        self.send("++auto %d" % auto)
-        self.send("++eoi %d" % eoi)
-        self.send("++eos %d" % eos)
-        self.send("++eot_enable %d" % eot_enable)
-        self.send("++eot_char %d" % eot_char)
-
+        # only the settings that the controller does not have already are sent
+        cmd = self.changed_settings(mode=mode,auto=auto,eoi=eoi,eos=eos,eot_enable=eot_enable,eot_char=eot_char)
+        if cmd:
+            self.send(cmd)
 #-----------------------------------------------------------------------------------------------------------
-    def scan_gpib_addresses(self):
-        if self.IS_TCP:
-            print("with TCP device we cannot scan the GPIB ports")
+    def changed_settings(self,**settings):
+        """
+        return the ++ commands (separated by ;) setting the controller to settings, skipping the
+        ones the state cache knows to be set already
+        """
+        return ";".join(["++%s %s" % (k,v) for k,v in settings.items() if self.state.get(k) != str(v)])
+#-----------------------------------------------------------------------------------------------------------
+    def invalidate_state(self):
+        self.state = {}
+#-----------------------------------------------------------------------------------------------------------
+    def message_address(self,msg):
+        """
+        return the address the controller is on once the message msg is sent, the one of its last
+        ++addr or the current one
+        """
+        address = self.state.get("addr")
+        if b"++addr" not in msg.lower():
+            return address
+        for c in msg.split(b";"):
+            words = to_str(c.strip().lower()).split()
+            if len(words) > 1 and words[0] == "++addr":
+                address = " ".join(words[1:])
+        return address
+#-----------------------------------------------------------------------------------------------------------
+    def update_state(self,msg):
+        """
+        keep the state cache in line with the ++ commands of the message msg
+        """
+        if self.cache is not None:
+            self._invalidate_cache(msg)
+        if b"++" not in msg:
             return
-        
-        lg=[]
-        print("Scanning gpib adresses ",end="",flush=True)
-        for a in range(31):
-            r = self.query("++spoll %d" % a).decode()
-           
-            if r:
-                print("G",end='', flush=True)
-                lg.append("found device at address %d" % a)
-            else:
-                print(".",end='', flush=True)
-        print(" Done\n\t- ",end='', flush=True)
-        print("\n\t- ".join(lg))
+        for c in msg.split(b";"):
+            c = c.strip().lower()
+            if not c.startswith(b"++"):
+                continue
+            words = to_str(c[2:]).split()
+            if words[0] in ("rst","ifc"):
+                self.invalidate_state()
+            elif words[0] in STATE_SETTINGS and len(words) > 1:
+                self.state[words[0]] = " ".join(words[1:])
+
+        if self.state.get("auto") in ("0","1"):
+            self.auto = int(self.state["auto"])
+        if self.state.get("eot_enable") == "0":
+            self.read_terminator = b"\n"
+        elif self.state.get("eot_enable") == "1" and self.state.get("eot_char","").isdigit():
+            self.read_terminator = bytes([int(self.state["eot_char"])])
+#-----------------------------------------------------------------------------------------------------------
+    def _reconnected(self):
+        # called by the transport once the connection is open again
+        if self.metrics is not None:
+            self.metrics.record_retry(self._last_cmd,self.state.get("addr"))
+        return self.replay_state()
+#-----------------------------------------------------------------------------------------------------------
+    def replay_state(self):
+        """
+        return the bytes restoring the cached settings, sent by the transport after a reconnection
+        """
+        cmd = ";".join(["++%s %s" % (k,v) for k,v in self.state.items() if k != "savecfg"])
+        return self.encode(cmd) if cmd else b""
+#-----------------------------------------------------------------------------------------------------------
+    def health(self):
+        """
+        return the health statistics of the connection (only tcp devices have some)
+        """
+        if hasattr(self.device,"health"):
+            return self.device.health()
+        return {}
+#-----------------------------------------------------------------------------------------------------------
+    def select(self,address,secondary=None):
+        """
+        address the instrument at address (and secondary address), ++addr is only sent when the
+        controller is addressed to another instrument
+        """
+        cmd = self.changed_settings(addr=gpib_address(address,secondary))
+        if cmd:
+            self.send(cmd)
+#-----------------------------------------------------------------------------------------------------------
+    def stream(self,address=None,secondary=None,**kwargs):
+        """
+        return a Prologix_Stream acquiring continuously from the instrument at address, to start
+        with start() or a with statement
+        """
+        return Prologix_Stream(self,address,secondary,**kwargs)
+#-----------------------------------------------------------------------------------------------------------
+    def instrument(self,address,secondary=None):
+        """
+        return a Prologix_Instrument to talk to the instrument at address
+        """
+        return Prologix_Instrument(self,address,secondary)
+
+#-----------------------------------------------------------------------------------------------------------
+    def scan_gpib_addresses(self,secondary=False,idn=False,read_tmo_ms=SCAN_READ_TMO_MS,verbose=True):
+        """
+        serial poll the GPIB addresses 0-30, and their secondary addresses 96-126 if secondary is
+        True, with the read timeout of the controller lowered to read_tmo_ms. Return the list of
+        the devices found as dicts with the keys address, secondary, status and idn (the reply to
+        *IDN? if idn is True, None otherwise).
+        """
+        old_tmo = self.state.get("read_tmo_ms") or to_str(self.query("++read_tmo_ms")).strip()
+        old_addr = ""
+        if idn:
+            old_addr = self.state.get("addr") or to_str(self.query("++addr")).strip()
+        # an empty address costs the controller timeout, we wait a bit more to get its reply
+        timeout = read_tmo_ms/1000. + SCAN_MARGIN
+
+        found=[]
+        if verbose:
+            print("Scanning gpib adresses ",end="",flush=True)
+        self.send("++read_tmo_ms %d" % read_tmo_ms)
+        try:
+            for a in range(31):
+                for s in [None] + (list(range(96,127)) if secondary else []):
+                    address = gpib_address(a,s)
+                    r = to_str(self.query("++spoll %s" % address,timeout=timeout)).strip()
+                    if not r:
+                        if verbose and s is None:
+                            print(".",end='', flush=True)
+                        continue
+                    if verbose:
+                        print("G",end='', flush=True)
+                    found.append({"address" : a,
+                                  "secondary" : s,
+                                  "status" : int(r) if r.isdigit() else r,
+                                  "idn" : None})
+
+            if idn:
+                for d in found:
+                    self.select(d["address"],d["secondary"])
+                    d["idn"] = to_str(self.query("*IDN?",timeout=timeout)).strip()
+        finally:
+            if not old_tmo.isdigit():
+                old_tmo = "%d" % (TIMEOUT*1000)
+            self.send("++read_tmo_ms %s" % old_tmo)
+            if old_addr:
+                self.select(*[int(a) for a in old_addr.split()])
+
+        if verbose:
+            print(" Done\n\t- ",end='', flush=True)
+            print("\n\t- ".join(["found device at address %s (status %s) %s" %
+                                  (gpib_address(d["address"],d["secondary"]),d["status"],d["idn"] or "")
+                                  for d in found]))
+        return found
 
 #-----------------------------------------------------------------------------------------------------------
     def print_info(self):
@@ -249,76 +1024,931 @@ class Prologix_Device():
             for k,v in self.serial_info.items(): 
                 print("\t%-20s : %s" % (k,v) ) 
             
+#-----------------------------------------------------------------------------------------------------------
+    def encode(self,msg):
+        """
+        return the bytes to write to the prologix for the message msg
+        """
+        return encode_command(msg)
 #-----------------------------------------------------------------------------------------------------------
     def send(self,msg):
         """
         send the message to the prologix
         """
-        s_msg = to_bytes(msg)
-
-        full_command = b""
-        for c in s_msg.split(b";"):
-            if self.check_command(c): #c.startswith(b"++"):
-                full_command += c+b"\n"
-                logging.debug("prologix command %s" % repr(c+b"\n"))
-            else:
-                full_command += c+self.gpib_eot
-                logging.debug("GPIB command %s" % repr(c+self.gpib_eot))
-
-
-        logging.info("Sending Data %s",repr(full_command))
-        self._write(full_command)
+        msg = to_bytes(msg)
+        full_command = self.encode(msg)
+        logging.info("Sending Data %r",full_command)
+        self._write_frame(full_command,msg)
+        self.update_state(msg)
 #-----------------------------------------------------------------------------------------------------------
-    def read(self,n_bytes=1000):
+    def enable_metrics(self,metrics=None):
+        """
+        start recording the metrics of the traffic in metrics (a new Prologix_Metrics by default)
+        and return it. They are then available in self.metrics.
+        """
+        self.metrics = metrics if metrics is not None else Prologix_Metrics()
+        return self.metrics
+#-----------------------------------------------------------------------------------------------------------
+    def enable_cache(self,cache=None,name=None):
+        """
+        let query() answer the queries cached in cache (a new Query_Cache by default) without going
+        to the bus and return it. A cache shared by several controllers needs their names.
+        """
+        self.cache = cache if cache is not None else Query_Cache()
+        self.cache_name = name if name is not None else id(self)
+        return self.cache
+#-----------------------------------------------------------------------------------------------------------
+    def _invalidate_cache(self,msg):
+        # the address changes along the message with its ++addr
+        address = self.state.get("addr")
+        for c in msg.split(b";"):
+            c = c.strip()
+            if not c:
+                continue
+            if c.startswith(b"++"):
+                words = to_str(c[2:].lower()).split()
+                if not words:
+                    continue
+                if words[0] == "addr" and len(words) > 1:
+                    address = " ".join(words[1:])
+                elif words[0] == "clr":
+                    self.cache.invalidate(self.cache_name,address)
+                elif words[0] in ("rst","ifc") or (words[0] in ("eot_enable","eot_char") and len(words) > 1):
+                    self.cache.invalidate(self.cache_name)
+            elif not c.endswith(b"?"):
+                # a setting, or a command of unknown effect, changes what the instrument answers
+                self.cache.invalidate(self.cache_name,address)
+#-----------------------------------------------------------------------------------------------------------
+    def enable_adaptive_timeouts(self,timeouts=None):
+        """
+        let query() set the timeouts, ++read_tmo_ms and the host side one, for the replies of each
+        instrument from its past response times in timeouts (a new Adaptive_Timeouts by default)
+        and return it
+        """
+        self.timeouts = timeouts if timeouts is not None else Adaptive_Timeouts()
+        return self.timeouts
+#-----------------------------------------------------------------------------------------------------------
+    def _write_frame(self,full_command,msg):
+        if not msg.startswith(b"++read"):
+            # the replies read next belong to this message
+            self._last_cmd = msg
+        metrics = self.metrics
+        t = time.perf_counter() if metrics is not None else 0.
+        # the write is counted on the address the message leaves the controller on, as its reply
+        address = self.message_address(msg) if metrics is not None else None
+        # after an error we do not know what the controller got, the state cache is dropped
+        try:
+            self._write(full_command)
+        except Exception:
+            self.invalidate_state()
+            if metrics is not None:
+                metrics.record_error(msg,address)
+            raise
+        if metrics is not None:
+            metrics.record_write(msg,address,len(full_command),time.perf_counter()-t)
+#-----------------------------------------------------------------------------------------------------------
+    def _read_frame(self,terminator,n_bytes,timeout=None,cmd=None):
+        metrics = self.metrics
+        t = time.perf_counter() if metrics is not None else 0.
+        try:
+            data = self._read_until(terminator, n_bytes, timeout)
+        except Exception:
+            self.invalidate_state()
+            if metrics is not None:
+                metrics.record_error(cmd or self._last_cmd,self.state.get("addr"))
+            raise
+        if metrics is not None:
+            metrics.record_read(cmd or self._last_cmd,self.state.get("addr"),len(data),time.perf_counter()-t)
+        return data
+#-----------------------------------------------------------------------------------------------------------
+    def read(self,n_bytes=MAX_READ_SIZE,terminator=None,timeout=None):
+        """
+        ask the addressed instrument to talk and return its reply as soon as the terminator
+        (self.read_terminator by default) is received
+        """
         logging.info("Reading Data")
         self.send(b"++read")
-        return self._read(n_bytes)
+        return self._read_frame(terminator or self.read_terminator, n_bytes, timeout)
+#-----------------------------------------------------------------------------------------------------------
+    def read_eoi(self,terminator=None,n_bytes=MAX_READ_SIZE,timeout=None):
+        """
+        read the reply to a ++read eoi already sent. The transports do not see EOI: a reply
+        starting with a definite length block #<n><length><data> is read by its length, followed
+        by the end of the message up to terminator (self.read_terminator by default), an
+        indefinite length block #0<data> is read until the controller stops sending for timeout
+        seconds and any other reply up to terminator. The bytes already received after the
+        terminator go with the reply, the instrument only talks once after ++read eoi.
+        """
+        terminator = terminator or self.read_terminator
+        head = self._read_frame(None,1,timeout)
+        if not head or head == terminator:
+            return head
+        if head != b"#":
+            data = head + self._read_frame(terminator,n_bytes-1,timeout)
+            return data + self._read_until(None,n_bytes-len(data),0.)
+        n_digits = self._read_frame(None,1,timeout)
+        if n_digits == b"0":
+            return head + n_digits + self._read_frame(None,n_bytes-2,timeout)
+        if not n_digits.isdigit():
+            if n_digits in (b"",terminator):
+                return head + n_digits
+            return head + n_digits + self._read_frame(terminator,n_bytes-2,timeout)
+        length = self._read_frame(None,int(n_digits),timeout)
+        if not length.isdigit():
+            return head + n_digits + length
+        data = head + n_digits + length + self._read_frame(None,int(length),timeout)
+        return data + self._read_frame(terminator,n_bytes,timeout)
+#-----------------------------------------------------------------------------------------------------------
+    def reply_framing(self,cmd):
+        """
+        return (need_read, terminator) for the reply to the command cmd. The prologix answers its
+        own commands directly with a line ending by CR LF, the instruments need a ++read unless
+        the read-after-write mode is on.
+        """
+        cmd = to_bytes(cmd).strip().lower()
+        if cmd.startswith(b"++read"):
+            return False, self.read_terminator
+        if cmd.startswith(b"++"):
+            return False, b"\n"
+        return not self.auto, self.read_terminator
 #-----------------------------------------------------------------------------------------------------------
-    def query(self,msg):
+    def read_reply(self,cmd,n_bytes=MAX_READ_SIZE,timeout=None):
+        """
+        read the reply to the command cmd (the last one sent)
+        """
+        need_read, terminator = self.reply_framing(cmd)
+        if need_read:
+            return self.read(n_bytes,terminator,timeout)
+        return self._read_frame(terminator, n_bytes, timeout)
+#-----------------------------------------------------------------------------------------------------------
+    def query(self,msg,n_bytes=MAX_READ_SIZE,timeout=None):
+        """
+        send msg and return the reply to its last command. timeout overrides the timeout of the
+        device for this reply.
+        """
+        if self.cache is not None:
+            ret_val = self._cached_query(msg)
+            if ret_val is not None:
+                return ret_val
         self.send(msg)
         logging.info("Reading Raw Data")
-        ret_val = self.read()
-        logging.info("==> %s " % repr(ret_val))
+        cmd = to_bytes(msg).split(b";")[-1]
+        if (self.timeouts is None or timeout is not None or cmd.strip().startswith(b"++")
+            or self.state.get("addr") is None):
+            ret_val = self.read_reply(cmd,n_bytes,timeout)
+        else:
+            address = self.state.get("addr")
+            timeout = self.timeouts.timeout(address)
+            setting = self.changed_settings(read_tmo_ms=max(1,min(3000,int(timeout*1000+0.5))))
+            if setting:
+                self.send(setting)
+            t = time.perf_counter()
+            ret_val = self.read_reply(cmd,n_bytes,timeout+ADAPTIVE_HOST_MARGIN)
+            self.timeouts.record(address,time.perf_counter()-t if ret_val else None)
+        logging.info("==> %r ",ret_val)
+        if self.cache is not None and ret_val and self.cache.cacheable(cmd):
+            self.cache.put(self.cache_name,None if cmd.strip().startswith(b"++") else self.state.get("addr"),
+                           cmd,ret_val)
         return ret_val
 #-----------------------------------------------------------------------------------------------------------
-    def check_command(self,cmd):
-
-        list_of_available_commands=[ b"++addr",
-                                     b"++auto",
-                                     b"++clr",
-                                     b"++eoi",
-                                     b"++eos",
-                                     b"++eot_enable",
-                                     b"++eot_char",
-                                     b"++ifc",
-                                     b"++loc",
-                                     b"++lon",
-                                     b"++mode",
-                                     b"++read",
-                                     b"++read_tmo_ms",
-                                     b"++rst",
-                                     b"++savecfg",
-                                     b"++spoll",
-                                     b"++srq",
-                                     b"++status",
-                                     b"++trg",
-                                     b"++ver",
-                                     b"++help"]
-
-        # we try to see if you have a prology command or not. It starts by ++ and should be one of the list above
+    def _cached_query(self,msg):
+        # only the messages made of a query, optionally after ++addr, are answered from the cache
+        commands = [c.strip() for c in to_bytes(msg).split(b";") if c.strip()]
+        if not commands or len(commands) > 2 or not self.cache.cacheable(commands[-1]):
+            return None
+        address = self.state.get("addr")
+        if len(commands) == 2:
+            words = to_str(commands[0].lower()).split()
+            if words[0] != "++addr" or len(words) < 2:
+                return None
+            address = " ".join(words[1:])
+        cmd = commands[-1]
         if cmd.startswith(b"++"):
-            is_prologix_command = False
-            for i in list_of_available_commands:
-                if cmd.lower().startswith(i):
-                    is_prologix_command=True
-                    break
-            if is_prologix_command:
-                return True
+            ret_val = self.cache.get(self.cache_name,None,cmd)
+        elif address is None:
+            return None
+        else:
+            ret_val = self.cache.get(self.cache_name,address,cmd)
+        if ret_val is not None:
+            # the controller must still end up on the address of the message
+            setting = self.changed_settings(addr=address) if address is not None and len(commands) == 2 else ""
+            if setting:
+                self.send(setting)
+            logging.info("==> %r (cached)",ret_val)
+        return ret_val
+#-----------------------------------------------------------------------------------------------------------
+    def query_binary(self,msg,dtype=None,out=None,timeout=None):
+        """
+        send the query msg whose reply is an IEEE 488.2 block #<n><length><data> and return the
+        data as a bytearray, or as a memoryview on the first bytes of out (a writable buffer large
+        enough) if given. With a dtype the data is returned as a numpy array of this dtype that
+        shares the buffer. The transports do not see EOI: an indefinite length block #0<data> is
+        read until the controller stops sending for timeout seconds and its final LF is dropped.
+        """
+        self.send(msg)
+        need_read, terminator = self.reply_framing(to_bytes(msg).split(b";")[-1])
+        if need_read:
+            # the length of the block is known, the controller only has to stop at EOI
+            self.send(b"++read eoi")
+
+        # whatever comes before the # (an echo of the command for some instruments) is skipped
+        if not self._read_frame(b"#",MAX_READ_SIZE,timeout).endswith(b"#"):
+            raise Exception("no binary block in the reply to %s" % repr(msg))
+        n_digits = self._read_frame(None,1,timeout)
+        if not n_digits.isdigit():
+            raise Exception("bad binary block header #%s in the reply to %s" % (repr(n_digits),repr(msg)))
+
+        if n_digits == b"0":
+            # indefinite length block, it ends with a LF sent with EOI. The data may hold LFs so
+            # the block is read until the controller stops, up to MAX_READ_SIZE bytes.
+            data = self._read_frame(None,MAX_READ_SIZE,timeout)
+            if data.endswith(b"\n"):
+                data = data[:-1]
+            length = len(data)
+            if out is None:
+                data = bytearray(data)
             else:
-                print("%s unknown !! "% cmd)
-                print(help_usage)
+                if memoryview(out).nbytes < length:
+                    raise Exception("the buffer is too small for the %d bytes of the block" % length)
+                memoryview(out).cast("B")[:length] = data
+                data = out
+        else:
+            length = self._read_frame(None,int(n_digits),timeout)
+            if not length.isdigit():
+                raise Exception("bad binary block length %s in the reply to %s" % (repr(length),repr(msg)))
+            length = int(length)
+            data = bytearray(length) if out is None else out
+            if memoryview(data).nbytes < length:
+                raise Exception("the buffer is too small for the %d bytes of the block" % length)
+            t = time.perf_counter()
+            try:
+                n = self._read_into(memoryview(data).cast("B")[:length],timeout)
+            except Exception:
+                self.invalidate_state()
+                if self.metrics is not None:
+                    self.metrics.record_error(msg,self.state.get("addr"))
+                raise
+            if self.metrics is not None:
+                self.metrics.record_read(msg,self.state.get("addr"),n,time.perf_counter()-t)
+            if n < length:
+                raise Exception("binary block cut after %d bytes out of %d" % (n,length))
+            # the block is followed by the end of the message
+            self._read_frame(terminator,len(terminator),timeout)
+
+        if dtype is None:
+            return data if out is None else memoryview(out).cast("B")[:length]
+        import numpy
+        return numpy.frombuffer(data,dtype=dtype,count=length//numpy.dtype(dtype).itemsize)
+#-----------------------------------------------------------------------------------------------------------
+    def query_many(self,msgs,n_bytes=MAX_READ_SIZE,batch_size=16,return_exceptions=False):
+        """
+        send the queries of the list msgs pipelined, batch_size queries (with their ++read) per
+        write, and return the list of the replies in the same order. As with query(), a query
+        without reply before the timeout gives b"". A message that can not be sent (e.g. an unknown
+        ++ command) is left out of its batch, and a failed write or read fails the rest of its
+        batch. All the batches are run anyway, then the first error is raised or, with
+        return_exceptions, the errors take the place of the replies in the list.
+        """
+        replies = [None]*len(msgs)
+        errors = []
+        for i in range(0,len(msgs),batch_size):
+            full_command = b""
+            batch = []
+            for k in range(i,min(i+batch_size,len(msgs))):
+                msg = to_bytes(msgs[k])
+                try:
+                    full_command += self.encode(msg)
+                except Exception as e:
+                    replies[k] = e
+                    errors.append(e)
+                    continue
+                need_read, terminator = self.reply_framing(msg.split(b";")[-1])
+                if need_read:
+                    full_command += b"++read\n"
+                batch.append((k,msg,terminator))
+            if not batch:
+                continue
+
+            done = 0
+            try:
+                logging.info("Sending Data %r",full_command)
+                self._write_frame(full_command,batch[0][1])
+                for k,msg,terminator in batch:
+                    self.update_state(msg)
+                for k,msg,terminator in batch:
+                    ret_val = self._read_frame(terminator, n_bytes, cmd=msg)
+                    if not ret_val:
+                        logging.warning("no reply to query %d of the list",k)
+                    replies[k] = ret_val
+                    done += 1
+            except Exception as e:
+                for k,msg,terminator in batch[done:]:
+                    replies[k] = e
+                errors.append(e)
+        if errors and not return_exceptions:
+            raise errors[0]
+        return replies
+#-----------------------------------------------------------------------------------------------------------
+    def check_command(self,cmd):
+        return check_command(cmd)
+
+# a handle on one instrument of the bus
+#===========================================================================================================
+class Prologix_Instrument():
+    def __init__(self,device,address,secondary=None):
+        self.device = device
+        self.address = address
+        self.secondary = secondary
+#-----------------------------------------------------------------------------------------------------------
+    def select(self):
+        self.device.select(self.address,self.secondary)
+#-----------------------------------------------------------------------------------------------------------
+    def send(self,msg):
+        self.select()
+        self.device.send(msg)
+#-----------------------------------------------------------------------------------------------------------
+    def read(self,*args,**kwargs):
+        self.select()
+        return self.device.read(*args,**kwargs)
+#-----------------------------------------------------------------------------------------------------------
+    def query(self,msg,*args,**kwargs):
+        self.select()
+        return self.device.query(msg,*args,**kwargs)
+#-----------------------------------------------------------------------------------------------------------
+    def query_many(self,msgs,*args,**kwargs):
+        self.select()
+        return self.device.query_many(msgs,*args,**kwargs)
+#-----------------------------------------------------------------------------------------------------------
+    def query_binary(self,msg,*args,**kwargs):
+        self.select()
+        return self.device.query_binary(msg,*args,**kwargs)
+
+# share one Prologix_Device between threads. The requests are queued per GPIB address and served by
+# a worker thread which takes the requests of the address the controller is on first, so that the
+# ++addr switches are kept to a minimum. After max_burst requests in a row on one address it moves
+# on to the other addresses so that none of them starves.
+#
+# usage:
+#     sched = Prologix_Scheduler(p)
+#     f = sched.query(12,"*IDN?")      # from any thread
+#     print(f.result())
+#===========================================================================================================
+class Prologix_Scheduler():
+    def __init__(self,device,max_burst=32):
+        self.device = device
+        self.max_burst = max_burst
+        # address -> deque of (method, args, kwargs, future), the oldest address first
+        self._queues = collections.OrderedDict()
+        self._cond = threading.Condition()
+        self._running = True
+        self._current = None
+        self._burst = 0
+        self._thread = threading.Thread(target=self._run,name="prologix-scheduler",daemon=True)
+        self._thread.start()
+#-----------------------------------------------------------------------------------------------------------
+    def submit(self,address,method,*args,**kwargs):
+        """
+        queue the call device.method(*args,**kwargs) for the instrument at address (an int, a
+        (primary, secondary) tuple or None for the commands of the controller itself) and return
+        a concurrent.futures.Future of its result. method can also be a function called as
+        method(*args,**kwargs) once the instrument is addressed.
+        """
+        from concurrent.futures import Future
+
+        if isinstance(address,int):
+            address = (address,None)
+        future = Future()
+        with self._cond:
+            if not self._running:
+                raise Exception("the scheduler is closed")
+            if address not in self._queues:
+                self._queues[address] = collections.deque()
+            self._queues[address].append((method,args,kwargs,future))
+            self._cond.notify()
+        return future
+#-----------------------------------------------------------------------------------------------------------
+    def send(self,address,msg):
+        return self.submit(address,"send",msg)
+#-----------------------------------------------------------------------------------------------------------
+    def read(self,address,*args,**kwargs):
+        return self.submit(address,"read",*args,**kwargs)
+#-----------------------------------------------------------------------------------------------------------
+    def query(self,address,msg,*args,**kwargs):
+        return self.submit(address,"query",msg,*args,**kwargs)
+#-----------------------------------------------------------------------------------------------------------
+    def query_many(self,address,msgs,*args,**kwargs):
+        return self.submit(address,"query_many",msgs,*args,**kwargs)
+#-----------------------------------------------------------------------------------------------------------
+    def pending(self):
+        """
+        return the number of queued requests per address
+        """
+        with self._cond:
+            return dict([(a,len(q)) for a,q in self._queues.items()])
+#-----------------------------------------------------------------------------------------------------------
+    def close(self,wait=True,cancel=False):
+        """
+        stop the worker once the queued requests are served, or at once with the queued requests
+        failing if cancel is True
+        """
+        with self._cond:
+            self._running = False
+            if cancel:
+                for queue in self._queues.values():
+                    for method,args,kwargs,future in queue:
+                        if future.set_running_or_notify_cancel():
+                            future.set_exception(Exception("the scheduler is closed"))
+                self._queues.clear()
+            self._cond.notify()
+        if wait:
+            self._thread.join()
+#-----------------------------------------------------------------------------------------------------------
+    def _next(self):
+        # called with the lock held and at least one request queued
+        if self._current in self._queues and self._burst < self.max_burst:
+            self._burst += 1
+        else:
+            if self._current in self._queues:
+                self._queues.move_to_end(self._current)
+            self._current = next(iter(self._queues))
+            self._burst = 1
+        queue = self._queues[self._current]
+        request = queue.popleft()
+        if not queue:
+            del self._queues[self._current]
+        return self._current,request
+#-----------------------------------------------------------------------------------------------------------
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._queues:
+                    self._cond.wait()
+                if not self._queues:
+                    return
+                address,(method,args,kwargs,future) = self._next()
+
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                if address is not None:
+                    self.device.select(*address)
+                call = method if callable(method) else getattr(self.device,method)
+                future.set_result(call(*args,**kwargs))
+            except Exception as e:
+                future.set_exception(e)
+
+# a fixed size ring buffer between the thread acquiring the samples and their consumers. When it is
+# full the producer waits ("block") or the oldest sample is overwritten ("drop_oldest").
+#===========================================================================================================
+class Ring_Buffer():
+    def __init__(self,size,overflow="block"):
+        if overflow not in ("block","drop_oldest"):
+            raise Exception("overflow can only be block or drop_oldest but %s found" % overflow)
+        self.size = size
+        self.overflow = overflow
+        self.dropped = 0
+        self.closed = False
+        self._items = [None]*size
+        self._head = 0
+        self._count = 0
+        self._cond = threading.Condition()
+#-----------------------------------------------------------------------------------------------------------
+    def __len__(self):
+        return self._count
+#-----------------------------------------------------------------------------------------------------------
+    def put(self,item,timeout=None):
+        """
+        add item, return False if the buffer stayed full for timeout seconds or is closed
+        """
+        with self._cond:
+            if self._count == self.size:
+                if self.overflow == "drop_oldest":
+                    self._head = (self._head+1) % self.size
+                    self._count -= 1
+                    self.dropped += 1
+                elif not self._cond.wait_for(lambda: self._count < self.size or self.closed,timeout):
+                    return False
+            if self.closed:
                 return False
-        return True
+            self._items[(self._head+self._count) % self.size] = item
+            self._count += 1
+            self._cond.notify_all()
+            return True
+#-----------------------------------------------------------------------------------------------------------
+    def get_batch(self,max_items,timeout=None):
+        """
+        return the list of the oldest items, at most max_items, waiting up to timeout seconds for
+        the first one. The list is empty on timeout or when the buffer is closed and empty.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._count or self.closed,timeout)
+            n = min(max_items,self._count)
+            batch = []
+            for i in range(n):
+                j = (self._head+i) % self.size
+                batch.append(self._items[j])
+                self._items[j] = None
+            self._head = (self._head+n) % self.size
+            self._count -= n
+            self._cond.notify_all()
+            return batch
+#-----------------------------------------------------------------------------------------------------------
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+# continuous acquisition from one instrument. A thread reads the replies with as little traffic as
+# possible and puts (time, parse(reply)) samples in a Ring_Buffer that the consumers empty by batches:
+#   - with a trigger command, ++auto 1 makes the instrument talk after each trigger so no ++read
+#     is sent;
+#   - without trigger, the instrument which sends its readings continuously is read with ++read eoi;
+#   - with listen_only, the controller goes in device mode with ++lon 1 and gets the data of a talk
+#     only instrument without addressing it.
+# The settings changed are restored by stop().
+#
+# usage:
+#     with p.stream(12,trigger="READ?",overflow="drop_oldest") as s:
+#         for batch in s.batches(100):
+#             store(batch)
+#===========================================================================================================
+class Prologix_Stream():
+    def __init__(self,device,address=None,secondary=None,trigger=None,listen_only=False,
+                 parse=None,ring_size=STREAM_RING_SIZE,overflow="block"):
+        self.device = device
+        self.address = address
+        self.secondary = secondary
+        self.trigger = to_bytes(trigger) if trigger is not None else None
+        self.listen_only = listen_only
+        self.parse = parse if parse is not None else parse_numbers
+        self.ring = Ring_Buffer(ring_size,overflow)
+        self.error = None
+        self.n_samples = 0
+        self._running = False
+        self._restore = {}
+        self._thread = None
+#-----------------------------------------------------------------------------------------------------------
+    def _set(self,**settings):
+        # remember what to restore, the settings unknown to the state cache get their default
+        defaults = {"auto" : self.device.auto, "mode" : 1, "lon" : 0}
+        for k in settings:
+            if k not in self._restore:
+                self._restore[k] = self.device.state.get(k,defaults[k])
+        cmd = self.device.changed_settings(**settings)
+        if cmd:
+            self.device.send(cmd)
+#-----------------------------------------------------------------------------------------------------------
+    def start(self):
+        if self.listen_only:
+            self._set(mode=0,lon=1)
+        else:
+            if self.address is not None:
+                self.device.select(self.address,self.secondary)
+            self._set(auto=1 if self.trigger is not None else 0)
+        self._running = True
+        self._thread = threading.Thread(target=self._run,name="prologix-stream",daemon=True)
+        self._thread.start()
+        return self
+#-----------------------------------------------------------------------------------------------------------
+    def _read_sample(self):
+        device = self.device
+        if self.listen_only:
+            return device._read_frame(device.read_terminator,MAX_READ_SIZE)
+        if self.trigger is not None:
+            device.send(self.trigger)
+            return device.read_reply(self.trigger)
+        return device.query(b"++read eoi")
+#-----------------------------------------------------------------------------------------------------------
+    def _run(self):
+        try:
+            while self._running:
+                reply = self._read_sample()
+                if not reply:
+                    continue
+                sample = (time.time(),self.parse(reply))
+                # a full buffer in block mode stops the acquisition until the consumers catch up
+                while self._running:
+                    if self.ring.put(sample,0.1):
+                        self.n_samples += 1
+                        break
+        except Exception as e:
+            logging.error("stream stopped by %r",e)
+            self.error = e
+        finally:
+            self.ring.close()
+#-----------------------------------------------------------------------------------------------------------
+    def stop(self):
+        """
+        stop the acquisition and restore the settings of the controller, the samples still in
+        the buffer can be read
+        """
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        # the reply to the last ++read eoi or trigger may still come, it is dropped
+        self.device._read_frame(self.device.read_terminator,MAX_READ_SIZE,0.05)
+        # ++lon applies in device mode, it is restored before going back to controller mode
+        restore = dict([(k,self._restore[k]) for k in sorted(self._restore,key=lambda k: k != "lon")])
+        cmd = self.device.changed_settings(**restore)
+        if cmd:
+            self.device.send(cmd)
+        self._restore = {}
+#-----------------------------------------------------------------------------------------------------------
+    def __enter__(self):
+        return self.start()
+#-----------------------------------------------------------------------------------------------------------
+    def __exit__(self,*exc):
+        self.stop()
+#-----------------------------------------------------------------------------------------------------------
+    def batches(self,max_batch=STREAM_BATCH_SIZE,timeout=None):
+        """
+        generator of the lists of at most max_batch (time, value) samples, until the stream is
+        stopped and empty (or nothing comes during timeout seconds)
+        """
+        while True:
+            batch = self.ring.get_batch(max_batch,timeout)
+            if not batch:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield batch
+#-----------------------------------------------------------------------------------------------------------
+    def __iter__(self):
+        for batch in self.batches():
+            for sample in batch:
+                yield sample
+#-----------------------------------------------------------------------------------------------------------
+    async def abatches(self,max_batch=STREAM_BATCH_SIZE,timeout=None):
+        """
+        same as batches for asyncio, the wait happens in the default executor
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await loop.run_in_executor(None,self.ring.get_batch,max_batch,timeout)
+            if not batch:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield batch
+
+# dispatch of the service requests of the instruments. A thread watches the SRQ line with ++srq, which
+# is the only traffic while no instrument needs anything, and serial polls the watched addresses
+# when it is asserted. The instruments requesting service (bit RQS of their status byte) trigger the
+# callbacks and futures registered for them. When none of them requests service, the whole bus is
+# serial polled once, which clears the request of an instrument that is not watched, and if SRQ is
+# still held the checks are slowed down up to SRQ_MAX_INTERVAL until it is released. With a
+# Prologix_Scheduler the traffic goes through it so that other threads can use the controller
+# meanwhile.
+#
+# usage:
+#     srq = SRQ_Dispatcher(p)
+#     srq.on(12,lambda address,status: print("12 has data"))
+#     f = srq.wait(5)
+#     srq.start()
+#===========================================================================================================
+class SRQ_Dispatcher():
+    def __init__(self,device,interval=SRQ_POLL_INTERVAL,scheduler=None):
+        self.device = device
+        self.interval = interval
+        self.scheduler = scheduler
+        # address -> list of (mask, callback), address -> list of (mask, future)
+        self.callbacks = {}
+        self.futures = {}
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread = None
+        # number of checks in a row with SRQ asserted and no request found
+        self._unexplained = 0
+#-----------------------------------------------------------------------------------------------------------
+    def _address(self,address,secondary=None):
+        if isinstance(address,tuple):
+            return address
+        return (address,secondary)
+#-----------------------------------------------------------------------------------------------------------
+    def on(self,address,callback,mask=RQS,secondary=None):
+        """
+        call callback(address, status) each time the instrument at address requests service with
+        one of the bits of mask set in its status byte
+        """
+        with self._lock:
+            self.callbacks.setdefault(self._address(address,secondary),[]).append((mask,callback))
+#-----------------------------------------------------------------------------------------------------------
+    def remove(self,address,callback,secondary=None):
+        with self._lock:
+            address = self._address(address,secondary)
+            self.callbacks[address] = [(m,c) for m,c in self.callbacks.get(address,[]) if c is not callback]
+            if not self.callbacks[address]:
+                del self.callbacks[address]
+#-----------------------------------------------------------------------------------------------------------
+    def wait(self,address,mask=RQS,secondary=None):
+        """
+        return a concurrent.futures.Future of the status byte of the next service request of the
+        instrument at address with one of the bits of mask set
+        """
+        from concurrent.futures import Future
+        future = Future()
+        with self._lock:
+            self.futures.setdefault(self._address(address,secondary),[]).append((mask,future))
+        return future
+#-----------------------------------------------------------------------------------------------------------
+    def _query(self,msg):
+        if self.scheduler is not None:
+            return self.scheduler.query(None,msg).result()
+        return self.device.query(msg)
+#-----------------------------------------------------------------------------------------------------------
+    def poll_once(self):
+        """
+        check SRQ and, if it is asserted, serial poll the watched addresses and dispatch the
+        requests. Return the list of the (address, status) requesting service.
+        """
+        if to_str(self._query(b"++srq")).strip() != "1":
+            self._unexplained = 0
+            return []
+        with self._lock:
+            addresses = list(set(self.callbacks) | set(self.futures))
+
+        requests = []
+        for address in addresses:
+            status = to_str(self._query("++spoll %s" % gpib_address(*address))).strip()
+            if status.isdigit() and int(status) & RQS:
+                requests.append((address,int(status)))
+        for address,status in requests:
+            self._dispatch(address,status)
+        if requests:
+            self._unexplained = 0
+        elif not self._unexplained:
+            requests = self._poll_bus(addresses)
+            self._unexplained = 0 if requests else 1
+        else:
+            if self._unexplained == 1:
+                logging.warning("SRQ held by an instrument which does not answer the serial polls, "
+                                "checking it every %g s until it is released" % SRQ_MAX_INTERVAL)
+            self._unexplained += 1
+        return requests
+#-----------------------------------------------------------------------------------------------------------
+    def _poll_bus(self,watched):
+        # the serial poll clears the request of the instrument. The scan of the bus lowers the read
+        # timeout of the controller so the addresses without instrument cost little. A watched
+        # instrument requesting service meanwhile is dispatched as usual.
+        if self.scheduler is not None:
+            found = self.scheduler.submit(None,"scan_gpib_addresses",verbose=False).result()
+        else:
+            found = self.device.scan_gpib_addresses(verbose=False)
+        requests = []
+        for d in found:
+            address = (d["address"],d["secondary"])
+            if not isinstance(d["status"],int) or not d["status"] & RQS:
+                continue
+            if address in watched:
+                requests.append((address,d["status"]))
+                self._dispatch(address,d["status"])
+            else:
+                logging.warning("SRQ of the address %s which is not watched cleared" % gpib_address(*address))
+        return requests
+#-----------------------------------------------------------------------------------------------------------
+    def _interval(self):
+        if self._unexplained < 2:
+            return self.interval
+        return min(SRQ_MAX_INTERVAL,self.interval*2**min(self._unexplained-1,20))
+#-----------------------------------------------------------------------------------------------------------
+    def _dispatch(self,address,status):
+        with self._lock:
+            callbacks = [c for m,c in self.callbacks.get(address,[]) if status & m]
+            futures = [f for m,f in self.futures.get(address,[]) if status & m]
+            if address in self.futures:
+                self.futures[address] = [(m,f) for m,f in self.futures[address] if not status & m]
+                if not self.futures[address]:
+                    del self.futures[address]
+        a = address[0] if address[1] is None else address
+        for callback in callbacks:
+            try:
+                callback(a,status)
+            except Exception:
+                logging.exception("SRQ callback of address %s failed",gpib_address(*address))
+        for future in futures:
+            if future.set_running_or_notify_cancel():
+                future.set_result(status)
+#-----------------------------------------------------------------------------------------------------------
+    def _run(self):
+        while self._running:
+            try:
+                if not self.poll_once():
+                    time.sleep(self._interval())
+            except Exception as e:
+                logging.error("SRQ polling failed: %r",e)
+                time.sleep(self.interval)
+#-----------------------------------------------------------------------------------------------------------
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run,name="prologix-srq",daemon=True)
+        self._thread.start()
+        return self
+#-----------------------------------------------------------------------------------------------------------
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+#-----------------------------------------------------------------------------------------------------------
+    def __enter__(self):
+        return self.start()
+#-----------------------------------------------------------------------------------------------------------
+    def __exit__(self,*exc):
+        self.stop()
+
+#===========================================================================================================
+def scan_controllers(devices,**kwargs):
+    """
+    scan the GPIB buses of several Prologix_Device in parallel (one thread per controller) and
+    return the lists of devices found, in the order of devices. kwargs are passed to
+    scan_gpib_addresses.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    kwargs.setdefault("verbose",False)
+    with ThreadPoolExecutor(max_workers=max(1,len(devices))) as executor:
+        return list(executor.map(lambda d: d.scan_gpib_addresses(**kwargs),devices))
+#-----------------------------------------------------------------------------------------------------------
+def parse_script(text):
+    """
+    return the list of (line number, kind, command, count) of a script of the batch mode of the
+    command line: one command per line with the prefixes of the interactive mode, (q)uery, (s)end
+    or (r)ead, optionally preceded by a repeat count as in "100*qREAD?". Empty lines and lines
+    starting with # are skipped.
+    """
+    script = []
+    for lineno,line in enumerate(text.splitlines(),1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        count = 1
+        head,sep,rest = line.partition("*")
+        if sep and head.strip().isdigit():
+            count = int(head)
+            line = rest.strip()
+        if not line or line[0] not in "qsr" or (line[0] == "r" and line != "r"):
+            raise Exception("line %d: %s should start with (s)end, (q)uery or be (r)ead" % (lineno,line))
+        script.append((lineno,line[0],line[1:],count))
+    return script
+
+#-----------------------------------------------------------------------------------------------------------
+def run_script(p,script,repeat=1,batch_size=16):
+    """
+    run the script of parse_script repeat times on the Prologix_Device p and yield a dict per command
+    run with its line, command, reply (for the queries and reads), start time and duration. The
+    consecutive queries are pipelined with query_many, batch_size per write, and get the duration
+    of their batch. A command that fails gives its error instead of a reply.
+    """
+    def result(lineno,cmd,start,seconds,reply=None,error=None,batch=1):
+        res = {"line" : lineno, "cmd" : cmd, "start" : start, "seconds" : seconds, "batch" : batch}
+        if reply is not None:
+            res["reply"] = reply.decode(errors="replace").rstrip("\r\n")
+        if error is not None:
+            res["error"] = "%s: %s" % (type(error).__name__,error)
+        return res
+
+    def run_queries(queries):
+        start = time.time()
+        t = time.perf_counter()
+        replies = p.query_many([cmd for lineno,cmd in queries],batch_size=batch_size,return_exceptions=True)
+        seconds = time.perf_counter()-t
+        results = []
+        for (lineno,cmd),reply in zip(queries,replies):
+            if isinstance(reply,Exception):
+                results.append(result(lineno,cmd,start,seconds,error=reply,batch=len(queries)))
+            else:
+                results.append(result(lineno,cmd,start,seconds,reply,batch=len(queries)))
+        return results
+
+    queries = []
+    for i in range(repeat):
+        for lineno,kind,cmd,count in script:
+            for j in range(count):
+                if kind == "q":
+                    queries.append((lineno,cmd))
+                    if len(queries) == batch_size:
+                        for res in run_queries(queries):
+                            yield res
+                        queries = []
+                    continue
+                if queries:
+                    for res in run_queries(queries):
+                        yield res
+                    queries = []
+                start = time.time()
+                t = time.perf_counter()
+                try:
+                    reply = p.read() if kind == "r" else p.send(cmd)
+                except Exception as e:
+                    yield result(lineno,cmd,start,time.perf_counter()-t,error=e)
+                    continue
+                yield result(lineno,cmd,start,time.perf_counter()-t,reply)
+    if queries:
+        for res in run_queries(queries):
+            yield res
+
 #===========================================================================================================
 
 
@@ -332,14 +1962,23 @@ if __name__=="__main__":
     parser.add_argument("device", choices=["usb", "tcp", "dummy","prologix_cmd"],
                     help="define the  type of connection to the prologix or print prologix command")
     
-    parser.add_argument("-s", "--serial_number",help="Serial number (only for serial)",default=None)
-    parser.add_argument("-b","--baudrate", help="baudrate (only for serial)",default=9600)
-    parser.add_argument("-i", "--ip",help="IP address of the device (only for tcp)",default=None)
+    parser.add_argument("-s", "--serial_number",help="Serial number (only for serial), several for a script",
+                        nargs="+",default=None)
+    parser.add_argument("-b","--baudrate", help="baudrate (only for serial)",type=int,default=9600)
+    parser.add_argument("-i", "--ip",help="IP address of the device (only for tcp), several for a script",
+                        nargs="+",default=None)
     
-    parser.add_argument("-t","--timeout", help="timeout",default=TIMEOUT)
+    parser.add_argument("-t","--timeout", help="timeout",type=float,default=TIMEOUT)
     debug_choices=["critical","error","warning","info","debug"]
     parser.add_argument("-d","--debug_level", help="set debug level",choices=debug_choices,default="critical")
 
+    parser.add_argument("--script",help="run the commands of this file (- for stdin) instead of the interactive "
+                        "loop and print one json line per result",default=None)
+    parser.add_argument("--repeat",help="number of runs of the script",type=int,default=1)
+    parser.add_argument("--batch_size",help="queries of the script per write",type=int,default=16)
+    parser.add_argument("--no_init",help="do not configure the controller nor print its info at start",
+                        action="store_true")
+
     #parser.add_argument("--gpib_eot",help="",default= "\r\n")
     
     args = parser.parse_args()
@@ -348,40 +1987,89 @@ if __name__=="__main__":
         print(help_usage)
         sys.exit(0)
     elif args.device == "dummy":
-        p = Prologix_Device(dev=args.device,
-                            debug_level=args.debug_level)
-
+        names = ["dummy"]
 
     elif args.device == "usb":
         if args.serial_number == None:
             print("usb need a serial_number!!")
             parser.print_help(sys.stderr)
             sys.exit(0)
-        p = Prologix_Device(dev=args.device,
-                            serial_number=args.serial_number,
-                            baudrate=args.baudrate,
-                            timeout=args.timeout,
-                            debug_level=args.debug_level)
+        names = args.serial_number
         
     elif args.device == "tcp":
         if args.ip == None:
             print("tcp device need an ip address!!")
             parser.print_help(sys.stderr)
             sys.exit(0)
-        p = Prologix_Device(dev=args.device,
-                            ip=args.ip,
-                            timeout=args.timeout,
-                            debug_level=args.debug_level)
-        
+        names = args.ip
         
     else:
         print("type %s not implemented yet" % args.device)
         sys.exit(0)
 
+    def open_controller(name):
+        if args.device == "dummy":
+            p = Prologix_Device(dev=args.device,
+                                debug_level=args.debug_level)
+        elif args.device == "usb":
+            p = Prologix_Device(dev=args.device,
+                                serial_number=name,
+                                baudrate=args.baudrate,
+                                timeout=args.timeout,
+                                debug_level=args.debug_level)
+        else:
+            p = Prologix_Device(dev=args.device,
+                                ip=name,
+                                timeout=args.timeout,
+                                debug_level=args.debug_level)
+        if not args.no_init:
+            p.config()
+        return p
+
+    if args.script is not None:
+        # batch mode: the script runs on all the controllers at the same time, the results are
+        # printed as json lines as they come
+        import json
+        from concurrent.futures import ThreadPoolExecutor
+
+        if args.script == "-":
+            text = sys.stdin.read()
+        else:
+            with open(args.script) as f:
+                text = f.read()
+        try:
+            script = parse_script(text)
+        except Exception as e:
+            print(e,file=sys.stderr)
+            sys.exit(2)
 
-    p.config()
+        output_lock = threading.Lock()
+        def run(name):
+            n_errors = 0
+            try:
+                p = open_controller(name)
+            except Exception as e:
+                results = [{"error" : "%s: %s" % (type(e).__name__,e)}]
+            else:
+                results = run_script(p,script,args.repeat,args.batch_size)
+            for res in results:
+                res["controller"] = name
+                n_errors += "error" in res
+                with output_lock:
+                    print(json.dumps(res),flush=True)
+            return n_errors
+
+        with ThreadPoolExecutor(max_workers=len(names)) as executor:
+            n_errors = sum(executor.map(run,names))
+        sys.exit(1 if n_errors else 0)
+
+    if len(names) > 1:
+        print("the interactive mode works with one controller")
+        sys.exit(0)
 
-    p.print_info()
+    p = open_controller(names[0])
+    if not args.no_init:
+        p.print_info()
     #p.scan_gpib_addresses()
         
                    
@@ -397,7 +2085,7 @@ examples:
     r
 
 to Quit the program type Q
-to Scan the gpib bus (only in usb) type S
+to Scan the gpib bus type S
 """
     
     print(interact_usage)
@@ -410,10 +2098,15 @@ to Scan the gpib bus (only in usb) type S
         elif cmd != "":
             if cmd=="S":
                 p.scan_gpib_addresses()
-            elif cmd[0]=="q":
-                print(p.query(cmd[1:]))
-            elif cmd[0]=="s":
-                p.send(cmd[1:])
+            elif cmd[0] in "qs":
+                try:
+                    if cmd[0]=="q":
+                        print(p.query(cmd[1:]))
+                    else:
+                        p.send(cmd[1:])
+                except Unknown_Command as e:
+                    print(e)
+                    print(help_usage)
             elif cmd=="r":
                 print(p.read())
             else:
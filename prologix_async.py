@@ -0,0 +1,252 @@
+import asyncio
+import logging
+
+from prologix import (TIMEOUT, PROLOGIX_PORT, READ_CHUNK_SIZE, MAX_READ_SIZE, dbg_lvl,
+                      to_bytes, to_str, serial_device, Prologix_Device)
+
+# asyncio version of the transports and of Prologix_Device so that one event loop can drive many
+# controllers.
+#
+# usage:
+#     p = Async_Prologix_Device(dev="tcp", ip="10.0.0.12")
+#     await p.connect()
+#     await p.config()
+#     print(await p.query("*IDN?"))
+#     await p.close()
+
+# base class of the async transports. Both of them feed an asyncio.StreamReader
+#===========================================================================================================
+class async_stream_device():
+    def __init__(self,timeout=TIMEOUT):
+        self.timeout = timeout
+        self.reader = None
+        # bytes received after the last terminator, they belong to the next reply
+        self._pending = bytearray()
+#-----------------------------------------------------------------------------------------------------------
+    def _pop_pending(self,n):
+        data = bytes(self._pending[:n])
+        del self._pending[:n]
+        return data
+#-----------------------------------------------------------------------------------------------------------
+    async def read(self,n):
+        if self._pending:
+            return self._pop_pending(n)
+        try:
+            return await asyncio.wait_for(self.reader.read(n),self.timeout)
+        except asyncio.TimeoutError:
+            return b""
+#-----------------------------------------------------------------------------------------------------------
+    async def read_until(self,terminator,size=MAX_READ_SIZE,timeout=None):
+        """
+        same as stream_device.read_until but waits without blocking the event loop
+        """
+        if timeout is None:
+            timeout = self.timeout
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        buf = self._pending
+        start = 0
+        while True:
+            if terminator:
+                i = buf.find(terminator,start)
+                if i >= 0:
+                    end = i + len(terminator)
+                    break
+            if len(buf) >= size:
+                end = size
+                break
+            remaining = deadline - loop.time()
+            data = b""
+            if remaining > 0:
+                try:
+                    data = await asyncio.wait_for(self.reader.read(READ_CHUNK_SIZE),remaining)
+                except asyncio.TimeoutError:
+                    pass
+            if not data:
+                end = len(buf)
+                break
+            # the terminator may be split between two chunks
+            start = max(0,len(buf) - len(terminator) + 1) if terminator else 0
+            buf += data
+            deadline = loop.time() + timeout
+        return self._pop_pending(min(end,size))
+
+#===========================================================================================================
+class async_tcp_device(async_stream_device):
+    def __init__(self, ip=None, timeout=TIMEOUT, port=PROLOGIX_PORT):
+        async_stream_device.__init__(self,timeout)
+        self.ip = ip
+        self.port = port
+        self.writer = None
+#-----------------------------------------------------------------------------------------------------------
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.ip,self.port),
+                                                          self.timeout)
+#-----------------------------------------------------------------------------------------------------------
+    async def write(self,msg):
+        self.writer.write(msg)
+        await self.writer.drain()
+#-----------------------------------------------------------------------------------------------------------
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+            self.writer = None
+
+# the serial port is opened in non blocking mode and the event loop watches its file descriptor
+#===========================================================================================================
+class async_serial_device(async_stream_device):
+    def __init__(self, serial_number=None, baudrate=9600, timeout=TIMEOUT):
+        async_stream_device.__init__(self,timeout)
+        if not serial_number:
+            raise Exception("Serial number not given")
+        self.serial_number = serial_number
+        self.baudrate = baudrate
+        self.serial_info = {}
+        self.device = None
+#-----------------------------------------------------------------------------------------------------------
+    # the port lookup is the one of the blocking transport
+    find_serial_dev = serial_device.find_serial_dev
+#-----------------------------------------------------------------------------------------------------------
+    def get_serial_info(self):
+        return self.serial_info
+#-----------------------------------------------------------------------------------------------------------
+    async def connect(self):
+        import serial
+        port = self.find_serial_dev(self.serial_number)
+        if port == None:
+            raise Exception("No port found for serial_number %s !!\nABORTING " % self.serial_number)
+        logging.debug("Debug async serial device serial_number %s (port %s)",self.serial_number,port)
+
+        self.device = serial.Serial(port,baudrate=self.baudrate,timeout=0)
+        self.reader = asyncio.StreamReader()
+        asyncio.get_running_loop().add_reader(self.device.fileno(),self._on_readable)
+#-----------------------------------------------------------------------------------------------------------
+    def _on_readable(self):
+        data = self.device.read(max(1,self.device.in_waiting))
+        if data:
+            self.reader.feed_data(data)
+#-----------------------------------------------------------------------------------------------------------
+    async def write(self,msg):
+        # the commands are short, the write goes in the output buffer of the driver
+        self.device.write(msg)
+#-----------------------------------------------------------------------------------------------------------
+    async def close(self):
+        if self.device is not None:
+            asyncio.get_running_loop().remove_reader(self.device.fileno())
+            self.device.close()
+            self.device = None
+
+# the async version of Prologix_Device
+#===========================================================================================================
+class Async_Prologix_Device():
+#-----------------------------------------------------------------------------------------------------------
+    def __init__(self,
+                 dev="tcp",
+                 ip=None,
+                 serial_number=None,
+                 baudrate=9600,
+                 timeout=TIMEOUT,
+                 gpib_eot="\r\n",
+                 debug_level="critical",
+                 port=PROLOGIX_PORT):
+
+        self.IS_USB = False
+        self.IS_TCP = False
+        self.serial_info = {}
+
+        if dbg_lvl.get(debug_level):
+            logging.getLogger().setLevel(dbg_lvl.get(debug_level))
+        else:
+            raise Exception("debug level %s not understood should be one of %s" % (debug_level,
+                                                                                   ", ".join(dbg_lvl.keys())))
+
+        if dev.lower() == "usb":
+            self.device = async_serial_device(serial_number,baudrate,timeout)
+            self.IS_USB = True
+        elif dev.lower() == "tcp":
+            self.device = async_tcp_device(ip,timeout,port)
+            self.IS_TCP = True
+        else:
+            raise Exception("device can only be of type usb or tcp but %s found" % dev)
+
+        self.gpib_eot = to_bytes(gpib_eot)
+        self.read_terminator = b"\n"
+        self.auto = 0
+        self.eot_enable = 0
+        self.eot_char = 10
+        # a query is a write followed by a read, the lock keeps them together when several
+        # tasks share the controller
+        self._lock = asyncio.Lock()
+#-----------------------------------------------------------------------------------------------------------
+    # the encoding of the commands is the one of Prologix_Device
+    check_command = Prologix_Device.check_command
+    encode = Prologix_Device.encode
+    reply_framing = Prologix_Device.reply_framing
+#-----------------------------------------------------------------------------------------------------------
+    async def connect(self):
+        await self.device.connect()
+        if self.IS_USB:
+            self.serial_info = self.device.get_serial_info()
+#-----------------------------------------------------------------------------------------------------------
+    async def close(self):
+        await self.device.close()
+#-----------------------------------------------------------------------------------------------------------
+    async def __aenter__(self):
+        await self.connect()
+        return self
+#-----------------------------------------------------------------------------------------------------------
+    async def __aexit__(self,*exc):
+        await self.close()
+#-----------------------------------------------------------------------------------------------------------
+    async def config(self,mode=1,auto=0,eoi=1,eos=1,eot_enable=0,eot_char=10):
+        await self.send("++mode %d;++auto %d;++eoi %d;++eos %d;++eot_enable %d;++eot_char %d" %
+                        (mode,auto,eoi,eos,eot_enable,eot_char))
+#-----------------------------------------------------------------------------------------------------------
+    def update_state(self,msg):
+        """
+        keep auto and read_terminator in line with the ++ commands of the message msg
+        """
+        for c in to_bytes(msg).split(b";"):
+            words = to_str(c.strip().lower()).split()
+            if len(words) < 2 or not words[1].isdigit():
+                continue
+            if words[0] == "++auto":
+                self.auto = int(words[1])
+            elif words[0] == "++eot_enable":
+                self.eot_enable = int(words[1])
+            elif words[0] == "++eot_char":
+                self.eot_char = int(words[1])
+        self.read_terminator = bytes([self.eot_char]) if self.eot_enable else b"\n"
+#-----------------------------------------------------------------------------------------------------------
+    async def _send(self,msg):
+        full_command = self.encode(msg)
+        logging.info("Sending Data %r",full_command)
+        await self.device.write(full_command)
+        self.update_state(to_bytes(msg))
+#-----------------------------------------------------------------------------------------------------------
+    async def _read_reply(self,cmd,n_bytes):
+        need_read, terminator = self.reply_framing(cmd)
+        if need_read:
+            await self._send(b"++read")
+        return await self.device.read_until(terminator,n_bytes)
+#-----------------------------------------------------------------------------------------------------------
+    async def send(self,msg):
+        """
+        send the message to the prologix
+        """
+        async with self._lock:
+            await self._send(msg)
+#-----------------------------------------------------------------------------------------------------------
+    async def read(self,n_bytes=MAX_READ_SIZE,terminator=None):
+        logging.info("Reading Data")
+        async with self._lock:
+            await self._send(b"++read")
+            return await self.device.read_until(terminator or self.read_terminator,n_bytes)
+#-----------------------------------------------------------------------------------------------------------
+    async def query(self,msg,n_bytes=MAX_READ_SIZE):
+        async with self._lock:
+            await self._send(msg)
+            ret_val = await self._read_reply(to_bytes(msg).split(b";")[-1],n_bytes)
+        logging.info("==> %r ",ret_val)
+        return ret_val
@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import logging
+import threading
+
+SERIAL_BY_ID="/dev/serial/by-id"
+INDEX_PATH=os.environ.get("PROLOGIX_INDEX",os.path.join(os.path.expanduser("~"),".cache","prologix","index.json"))
+TCP_MAX_AGE=24*3600.   # the ip of a MAC older than this is looked up again with NetFinder
+
+# an index of the controllers found so far, kept on disk so that the next sessions do not look for
+# them again: the ports of the USB controllers by serial number and the ips of the Ethernet ones
+# by MAC address. A serial number is first looked up with its link in /dev/serial/by-id, which
+# is cheap and always up to date, then in the index as long as its port still reports the serial
+# number (the names of the ports, COM<n> on Windows, are reused by the other adapters), and the
+# ports are only enumerated when both fail. The enumeration indexes all the ports at once so the
+# other controllers opened after it find their port in the index.
+#
+# usage:
+#     index = default_index()
+#     port,info = index.serial_port("PXG9ASAT")
+#     ip = index.ip("00:21:69:01:02:03")
+
+#-----------------------------------------------------------------------------------------------------------
+def serial_by_id(sn):
+    """
+    return the link of /dev/serial/by-id of the serial number sn or None. The names of the links
+    are usb-<vendor>_<product>_<serial number>-if<nn>-port<n>, the serial number must match as a
+    whole.
+    """
+    if not sn or not os.path.isdir(SERIAL_BY_ID):
+        return None
+    token = "_%s-" % sn
+    for name in sorted(os.listdir(SERIAL_BY_ID)):
+        link = os.path.join(SERIAL_BY_ID,name)
+        if token in name and os.path.islink(link):
+            return link
+    return None
+
+#-----------------------------------------------------------------------------------------------------------
+def port_serial_number(port):
+    """
+    return the serial number of the USB adapter of the serial port port or None
+    """
+    from serial.tools import list_ports
+    for p in list_ports.comports():
+        if p.device == port:
+            return p.serial_number
+    return None
+
+#===========================================================================================================
+class Discovery_Index():
+    def __init__(self,path=INDEX_PATH):
+        self.path = path
+        # serial number -> {"port", "by_id", "info", "seen"} and MAC -> {"ip", "name", "seen"}
+        self.usb = {}
+        self.tcp = {}
+        self._lock = threading.RLock()
+        self._enumerated = False
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    d = json.load(f)
+                self.usb = d.get("usb",{})
+                self.tcp = d.get("tcp",{})
+            except (OSError,ValueError) as e:
+                logging.warning("discovery index %s unreadable, starting a new one: %s" % (path,e))
+#-----------------------------------------------------------------------------------------------------------
+    def save(self):
+        if self.path is None:
+            return
+        with self._lock:
+            d = {"usb" : self.usb, "tcp" : self.tcp}
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".",exist_ok=True)
+                with open(self.path + ".tmp","w") as f:
+                    json.dump(d,f,indent=1)
+                os.replace(self.path + ".tmp",self.path)
+            except OSError as e:
+                logging.warning("can not save the discovery index %s: %s" % (self.path,e))
+#-----------------------------------------------------------------------------------------------------------
+    def enumerate_serial(self):
+        """
+        index all the serial ports with a serial number
+        """
+        from serial.tools import list_ports
+        with self._lock:
+            owners = {}
+            for p in list_ports.comports():
+                if not p.serial_number:
+                    continue
+                owners[p.device] = p.serial_number
+                info = dict([(k,v) for k,v in p.__dict__.items() if isinstance(v,(str,int,float)) or v is None])
+                self.usb[p.serial_number] = {"port" : p.device,
+                                             "by_id" : serial_by_id(p.serial_number),
+                                             "info" : info,
+                                             "seen" : time.time()}
+            # the ports taken over by other adapters are forgotten
+            for sn,entry in list(self.usb.items()):
+                if owners.get(entry["port"],sn) != sn:
+                    del self.usb[sn]
+            self._enumerated = True
+            self.save()
+#-----------------------------------------------------------------------------------------------------------
+    def serial_port(self,sn):
+        """
+        return the port of the USB controller with the serial number sn and the information of the
+        port found by the enumeration, (None, {}) if not found
+        """
+        with self._lock:
+            entry = self.usb.get(sn)
+            link = serial_by_id(sn)
+            if link is not None:
+                port = os.path.realpath(link)
+                if entry is None or entry["port"] != port or entry.get("by_id") != link:
+                    entry = dict(entry or {"info" : {}},port=port,by_id=link,seen=time.time())
+                    self.usb[sn] = entry
+                    self.save()
+                if not entry["info"] and not self._enumerated:
+                    # the link gives the port but not its information, the ports are enumerated once
+                    self.enumerate_serial()
+                    entry = self.usb.get(sn) or entry
+                    if entry["port"] != port:
+                        entry = dict(entry,port=port,by_id=link)
+                        self.usb[sn] = entry
+                return port,entry["info"]
+
+            # without by-id links the cached port is trusted as long as it has the same serial number
+            if entry is not None and not entry.get("by_id") and port_serial_number(entry["port"]) == sn:
+                return entry["port"],entry["info"]
+
+            logging.info("serial number %s not indexed, enumerating the serial ports" % sn)
+            self.enumerate_serial()
+            entry = self.usb.get(sn)
+            if entry is None or not os.path.exists(entry["port"]):
+                return None,{}
+            return entry["port"],entry["info"]
+#-----------------------------------------------------------------------------------------------------------
+    def update_tcp(self,records):
+        """
+        index the controllers of netfinder records
+        """
+        with self._lock:
+            for r in records:
+                self.tcp[r["mac"]] = {"ip" : r["ip"], "name" : r["name"], "seen" : time.time()}
+            self.save()
+#-----------------------------------------------------------------------------------------------------------
+    def ip(self,mac,max_age=TCP_MAX_AGE,timeout=None):
+        """
+        return the ip of the Ethernet controller with the MAC address mac (as 00:21:69:01:02:03),
+        looking for the controllers with NetFinder if it is not indexed since max_age seconds
+        """
+        mac = mac.upper().replace("-",":")
+        with self._lock:
+            entry = self.tcp.get(mac)
+            if entry is not None and time.time() - entry["seen"] < max_age:
+                return entry["ip"]
+
+        import netfinder
+        logging.info("MAC %s not indexed, looking for the controllers" % mac)
+        self.update_tcp(netfinder.find_controllers(timeout or netfinder.MAX_TIMEOUT))
+        with self._lock:
+            entry = self.tcp.get(mac)
+            return entry["ip"] if entry is not None else None
+
+_default_index = None
+_default_lock = threading.Lock()
+
+#-----------------------------------------------------------------------------------------------------------
+def default_index():
+    """
+    return the index of INDEX_PATH shared by the whole process
+    """
+    global _default_index
+    with _default_lock:
+        if _default_index is None:
+            _default_index = Discovery_Index()
+        return _default_index
@@ -0,0 +1,151 @@
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from prologix import Prologix_Device, Prologix_Scheduler
+
+RECONNECT_DELAY=1.       # first wait before trying to reopen a controller that failed
+MAX_RECONNECT_DELAY=60.  # the wait doubles after each failure up to this value
+
+# a pool of Prologix controllers. Each controller is opened from a dict of Prologix_Device arguments
+# with a "name" key and gets its own Prologix_Scheduler, so its requests run in its own worker thread
+# while the other controllers work in parallel. A controller that fails to open or loses its
+# connection is reopened in the background, the requests sent to it meanwhile fail at once.
+#
+# usage:
+#     pool = Prologix_Pool([{"name":"rack1", "dev":"tcp", "ip":"10.0.0.12"},
+#                           {"name":"rack2", "dev":"usb", "serial_number":"PXG9ASAT"}],
+#                          config={"auto":0})
+#     print(pool.query("rack1",12,"*IDN?").result())
+#     print(pool.query_all([("rack1",12,"READ?"), ("rack2",5,"READ?")]))
+#===========================================================================================================
+class Prologix_Pool():
+    def __init__(self,controllers,config=None,reconnect_delay=RECONNECT_DELAY):
+        """
+        controllers is the list of dicts of Prologix_Device arguments with a "name" key, config the
+        dict of arguments of Prologix_Device.config (None to leave the controllers as they are)
+        """
+        self.controllers = dict([(c["name"],dict(c)) for c in controllers])
+        self.config = config
+        self.reconnect_delay = reconnect_delay
+        self.schedulers = {}
+        # name -> last error of the controllers that are down
+        self.errors = {}
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._reconnecting = set()
+
+        with ThreadPoolExecutor(max_workers=max(1,len(self.controllers))) as executor:
+            list(executor.map(self._open,self.controllers))
+#-----------------------------------------------------------------------------------------------------------
+    def _connect(self,name):
+        kwargs = dict(self.controllers[name])
+        del kwargs["name"]
+        device = Prologix_Device(**kwargs)
+        if self.config is not None:
+            device.config(**self.config)
+        with self._lock:
+            self.schedulers[name] = Prologix_Scheduler(device)
+            self.errors.pop(name,None)
+#-----------------------------------------------------------------------------------------------------------
+    def _open(self,name):
+        try:
+            self._connect(name)
+        except Exception as e:
+            self._mark_down(name,e)
+#-----------------------------------------------------------------------------------------------------------
+    def _mark_down(self,name,error):
+        logging.error("controller %s is down: %s" % (name,error))
+        with self._lock:
+            scheduler = self.schedulers.pop(name,None)
+            self.errors[name] = error
+            start = name not in self._reconnecting and not self._closed.is_set()
+            if start:
+                self._reconnecting.add(name)
+        if scheduler is not None:
+            # the requests queued on the lost connection fail now, the one being served fails
+            # on the closed device instead of opening a new connection
+            scheduler.close(wait=False,cancel=True)
+            scheduler.device.close()
+        if start:
+            threading.Thread(target=self._reconnect,args=(name,),
+                             name="prologix-reconnect-%s" % name,daemon=True).start()
+#-----------------------------------------------------------------------------------------------------------
+    def _reconnect(self,name):
+        delay = self.reconnect_delay
+        while not self._closed.wait(delay):
+            try:
+                self._connect(name)
+                logging.info("controller %s is back" % name)
+                break
+            except Exception as e:
+                logging.warning("controller %s still down: %s" % (name,e))
+                with self._lock:
+                    self.errors[name] = e
+                delay = min(2*delay,MAX_RECONNECT_DELAY)
+        with self._lock:
+            self._reconnecting.discard(name)
+#-----------------------------------------------------------------------------------------------------------
+    def _check_result(self,name,scheduler,future):
+        # a transport error means the connection is lost, the other errors belong to the request.
+        # A reply lost with a connection that the transport opened again (Reply_Lost) only costs
+        # its request.
+        if isinstance(future.exception(),OSError) and self.schedulers.get(name) is scheduler:
+            self._mark_down(name,future.exception())
+#-----------------------------------------------------------------------------------------------------------
+    def submit(self,name,address,method,*args,**kwargs):
+        """
+        route the call method(*args,**kwargs) for the instrument at address to the worker of the
+        controller name and return a concurrent.futures.Future of its result
+        """
+        with self._lock:
+            scheduler = self.schedulers.get(name)
+            error = self.errors.get(name)
+        if scheduler is None:
+            future = Future()
+            if name not in self.controllers:
+                future.set_exception(Exception("unknown controller %s" % name))
+            else:
+                future.set_exception(Exception("controller %s is down: %s" % (name,error)))
+            return future
+
+        future = scheduler.submit(address,method,*args,**kwargs)
+        future.add_done_callback(lambda f: self._check_result(name,scheduler,f))
+        return future
+#-----------------------------------------------------------------------------------------------------------
+    def send(self,name,address,msg):
+        return self.submit(name,address,"send",msg)
+#-----------------------------------------------------------------------------------------------------------
+    def query(self,name,address,msg,*args,**kwargs):
+        return self.submit(name,address,"query",msg,*args,**kwargs)
+#-----------------------------------------------------------------------------------------------------------
+    def query_all(self,requests,timeout=None):
+        """
+        run the (controller, address, command) queries of requests, in parallel on the different
+        controllers, and return the list of their replies in the same order. A query that failed
+        gives its exception instead of a reply.
+        """
+        futures = [self.query(name,address,msg) for name,address,msg in requests]
+        results = []
+        for f in futures:
+            try:
+                results.append(f.result(timeout))
+            except Exception as e:
+                results.append(e)
+        return results
+#-----------------------------------------------------------------------------------------------------------
+    def status(self):
+        """
+        return a dict name -> None for the controllers up or the last error of the ones down
+        """
+        with self._lock:
+            return dict([(name,self.errors.get(name)) for name in self.controllers])
+#-----------------------------------------------------------------------------------------------------------
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            schedulers = list(self.schedulers.values())
+            self.schedulers = {}
+        for scheduler in schedulers:
+            scheduler.close()
+            scheduler.device.close()
@@ -0,0 +1,399 @@
+import time
+import json
+import select
+import socket
+import logging
+import threading
+
+from prologix import (PROLOGIX_PORT, MAX_READ_SIZE, ADAPTIVE_HOST_MARGIN, help_usage, gpib_address,
+                      Prologix_Device, Prologix_Scheduler)
+
+PAIR_WINDOW=0.01   # how long a write waits for the ++read of the same client before going alone
+
+# the settings each client sees as its own controller, with their values at connection and after ++rst
+CLIENT_SETTINGS = {"addr" : None,
+                   "auto" : 0,
+                   "eoi" : 1,
+                   "eos" : 0,
+                   "eot_enable" : 0,
+                   "eot_char" : 0,
+                   "lon" : 0,
+                   "mode" : 1,
+                   "read_tmo_ms" : 500,
+                   "savecfg" : 1,
+                   "status" : 0}
+# the ones set on the controller before the requests of a client
+CONTROLLER_SETTINGS = ("eoi","eos","eot_enable","eot_char","read_tmo_ms")
+# the settings of the controller for the json requests, the ones of Prologix_Device.config
+JSON_SETTINGS = {"eoi" : 1,
+                 "eos" : 1,
+                 "eot_enable" : 0,
+                 "eot_char" : 10,
+                 "read_tmo_ms" : 500}
+
+# a proxy sharing one controller between many clients. The proxy owns the Prologix_Device and its
+# Prologix_Scheduler, the requests of all the clients go through the scheduler so they are grouped
+# by GPIB address. Each client waits for its request to be served before the next one, which
+# gives every client a turn.
+#
+# Two protocols are served, on two ports:
+#   - the protocol of the controller: each client sees a controller of its own (++addr, ++auto,
+#     ++eot_char... are kept per client) so Prologix_Device(dev="tcp", ip=<proxy>) or any other
+#     Prologix software works unchanged. The writes to an instrument are held until the ++read
+#     that follows them (PAIR_WINDOW) so that a query and its reply are never split by the
+#     requests of another client.
+#   - json lines: {"id": 1, "address": "12", "method": "query", "msg": "*IDN?"} answered by
+#     {"id": 1, "reply": "...", "seconds": ...} or {"id": 1, "error": "..."}. method is send,
+#     read, query or query_many (with "msgs"), address is null for the controller commands.
+#
+# usage:
+#     proxy = Prologix_Proxy(Prologix_Device(dev="tcp", ip="10.0.0.12"))
+#     proxy.serve(port=1234)
+#     proxy.serve(port=1235, protocol="json")
+#     print(proxy.metrics())
+#
+#     python prologix_proxy.py tcp -i 10.0.0.12 --port 1234 --json_port 1235
+
+# the address of ++addr as a key of the scheduler
+def scheduler_address(addr):
+    if addr is None:
+        return None
+    words = str(addr).split()
+    return (int(words[0]),int(words[1]) if len(words) > 1 else None)
+
+# the address of the arguments of ++addr or ++spoll, None unless they are a primary address 0-30
+# optionally followed by a secondary address 96-126
+def checked_address(args):
+    if not 1 <= len(args) <= 2 or not all([a.isdigit() for a in args]):
+        return None
+    if int(args[0]) > 30 or (len(args) == 2 and not 96 <= int(args[1]) <= 126):
+        return None
+    return gpib_address(*[int(a) for a in args])
+
+#===========================================================================================================
+class Proxy_Client():
+    def __init__(self,name):
+        self.name = name
+        self.settings = dict(CLIENT_SETTINGS)
+        self.connected = time.time()
+        self.requests = 0
+        self.errors = 0
+        # time spent by the requests in the queue and being served
+        self.wait = 0.
+        self.max_wait = 0.
+#-----------------------------------------------------------------------------------------------------------
+    def address(self):
+        return scheduler_address(self.settings["addr"])
+#-----------------------------------------------------------------------------------------------------------
+    def terminator(self):
+        if self.settings["eot_enable"]:
+            return bytes([self.settings["eot_char"]])
+        return b"\n"
+#-----------------------------------------------------------------------------------------------------------
+    def snapshot(self):
+        return {"connected" : self.connected,
+                "requests" : self.requests,
+                "errors" : self.errors,
+                "mean_wait" : self.wait/self.requests if self.requests else 0.,
+                "max_wait" : self.max_wait}
+
+#===========================================================================================================
+class Prologix_Proxy():
+    def __init__(self,device,max_burst=32,configure=True):
+        """
+        device is the Prologix_Device of the controller, configured with auto 0 unless configure
+        is False
+        """
+        self.device = device
+        if configure:
+            device.config(auto=0)
+        self.scheduler = Prologix_Scheduler(device,max_burst)
+        self.version = None
+        self.clients = {}
+        self.max_queue_depth = 0
+        self._lock = threading.Lock()
+        self._servers = []
+        self._connections = set()
+        self._running = True
+#-----------------------------------------------------------------------------------------------------------
+    def call(self,client,address,method,*args,**kwargs):
+        """
+        run method (a method name of the device or a function) for address in the scheduler, wait
+        for its result and keep the statistics of the client
+        """
+        t = time.perf_counter()
+        future = self.scheduler.submit(address,method,*args,**kwargs)
+        depth = sum(self.scheduler.pending().values())
+        try:
+            return future.result()
+        except Exception:
+            client.errors += 1
+            raise
+        finally:
+            wait = time.perf_counter()-t
+            with self._lock:
+                self.max_queue_depth = max(self.max_queue_depth,depth)
+                client.requests += 1
+                client.wait += wait
+                client.max_wait = max(client.max_wait,wait)
+#-----------------------------------------------------------------------------------------------------------
+    def metrics(self):
+        """
+        return the number of clients, the requests queued per address, the current and largest
+        queue depth and the statistics of each client
+        """
+        pending = self.scheduler.pending()
+        with self._lock:
+            clients = dict([(name,c.snapshot()) for name,c in self.clients.items()])
+            max_depth = self.max_queue_depth
+        return {"clients" : len(clients),
+                "queue_depth" : sum(pending.values()),
+                "max_queue_depth" : max_depth,
+                "pending" : dict([(gpib_address(*a) if a is not None else "controller",n)
+                                  for a,n in pending.items()]),
+                "per_client" : clients}
+#-----------------------------------------------------------------------------------------------------------
+    def _transaction(self,client,writes,read):
+        # runs in the worker of the scheduler with the instrument of the client addressed. read is
+        # the ++read line of the client (++read, ++read eoi or ++read <char>) or None
+        device = self.device
+        cmd = device.changed_settings(**dict([(k,client.settings[k]) for k in CONTROLLER_SETTINGS]))
+        if cmd:
+            device.send(cmd)
+        for line in writes:
+            # the lines of the clients are forwarded as they are, escapes included
+            device._write_frame(line + b"\n",line)
+            device.update_state(line)
+        if read is None:
+            return b""
+        timeout = client.settings["read_tmo_ms"]/1000. + ADAPTIVE_HOST_MARGIN
+        words = read.split()
+        if len(words) > 1 and words[1].lower() == b"eoi":
+            device.send(b"++read eoi")
+            return device.read_eoi(client.terminator(),MAX_READ_SIZE,timeout)
+        if len(words) > 1 and words[1].isdigit() and int(words[1]) < 256:
+            device.send(b"++read %d" % int(words[1]))
+            return device._read_frame(bytes([int(words[1])]),MAX_READ_SIZE,timeout)
+        return device.read(MAX_READ_SIZE,client.terminator(),timeout)
+#-----------------------------------------------------------------------------------------------------------
+    def _command(self,client,line):
+        """
+        answer the ++ command line of client
+        """
+        words = line[2:].decode(errors="replace").split()
+        if not words:
+            return b"Unrecognized command\r\n"
+        name = words[0].lower()
+        args = words[1:]
+        settings = client.settings
+
+        if name == "addr":
+            if not args:
+                return b"%s\r\n" % (settings["addr"] or "").encode()
+            address = checked_address(args)
+            if address is None:
+                return b"Unrecognized command\r\n"
+            settings["addr"] = address
+        elif name in settings:
+            if not args:
+                return b"%d\r\n" % settings[name]
+            if not args[0].isdigit():
+                return b"Unrecognized command\r\n"
+            settings[name] = int(args[0])
+        elif name == "rst":
+            # only the controller of the client is reset, the real one is shared
+            client.settings = dict(CLIENT_SETTINGS)
+        elif name == "ver":
+            if self.version is None:
+                self.version = self.call(client,None,"query","++ver").strip().decode(errors="replace")
+            return b"%s (proxy)\r\n" % self.version.encode()
+        elif name == "help":
+            return help_usage.strip("\n").replace("\n","\r\n").encode() + b"\r\n"
+        elif name == "spoll":
+            address = checked_address(args) if args else settings["addr"]
+            if args and address is None:
+                return b"Unrecognized command\r\n"
+            if address is None:
+                return b""
+            return self.call(client,None,"query","++spoll %s" % address)
+        elif name == "srq":
+            return self.call(client,None,"query","++srq")
+        elif name in ("clr","trg","loc"):
+            if client.address() is not None:
+                self.call(client,client.address(),"send","++%s" % name)
+        elif name == "ifc":
+            self.call(client,None,"send","++ifc")
+        else:
+            return b"Unrecognized command\r\n"
+        return b""
+#-----------------------------------------------------------------------------------------------------------
+    def _serve_prologix(self,conn,client):
+        buf = b""
+        # the writes of the client waiting for their ++read
+        writes = []
+        while self._running:
+            if writes and b"\n" not in buf:
+                ready = select.select([conn],[],[],PAIR_WINDOW)[0]
+                if not ready:
+                    self.call(client,client.address(),self._transaction,client,writes,None)
+                    writes = []
+                    continue
+            data = conn.recv(4096)
+            if not data:
+                break
+            buf += data
+            while b"\n" in buf:
+                line,buf = buf.split(b"\n",1)
+                line = line.rstrip(b"\r")
+                if line.startswith(b"++read") and line[6:7] != b"_":
+                    reply = b""
+                    if client.address() is not None:
+                        reply = self.call(client,client.address(),self._transaction,client,writes,line)
+                    writes = []
+                elif line.startswith(b"++"):
+                    if writes:
+                        self.call(client,client.address(),self._transaction,client,writes,None)
+                        writes = []
+                    reply = self._command(client,line)
+                elif client.address() is None:
+                    reply = b""
+                elif client.settings["auto"]:
+                    reply = self.call(client,client.address(),self._transaction,client,writes+[line],b"++read")
+                    writes = []
+                else:
+                    writes.append(line)
+                    reply = b""
+                if reply:
+                    conn.sendall(reply)
+        if writes and self._running:
+            self.call(client,client.address(),self._transaction,client,writes,None)
+#-----------------------------------------------------------------------------------------------------------
+    def _json_transaction(self,method,*args):
+        # runs in the worker of the scheduler, the protocol clients may have left other settings
+        cmd = self.device.changed_settings(**JSON_SETTINGS)
+        if cmd:
+            self.device.send(cmd)
+        return getattr(self.device,method)(*args)
+#-----------------------------------------------------------------------------------------------------------
+    def _json_request(self,client,request):
+        address = scheduler_address(request.get("address"))
+        method = request.get("method","query")
+        if method in ("send","query"):
+            reply = self.call(client,address,self._json_transaction,method,request["msg"])
+        elif method == "read":
+            reply = self.call(client,address,self._json_transaction,"read")
+        elif method == "query_many":
+            replies = self.call(client,address,self._json_transaction,"query_many",request["msgs"])
+            return [r.decode(errors="replace") for r in replies]
+        else:
+            raise Exception("unknown method %s" % method)
+        return reply.decode(errors="replace") if reply is not None else None
+#-----------------------------------------------------------------------------------------------------------
+    def _serve_json(self,conn,client):
+        f = conn.makefile("rb")
+        for line in f:
+            if not line.strip():
+                continue
+            t = time.perf_counter()
+            request = None
+            try:
+                request = json.loads(line)
+                res = {"id" : request.get("id"), "reply" : self._json_request(client,request)}
+            except Exception as e:
+                res = {"id" : request.get("id") if isinstance(request,dict) else None,
+                       "error" : "%s: %s" % (type(e).__name__,e)}
+            res["seconds"] = time.perf_counter()-t
+            conn.sendall(json.dumps(res).encode() + b"\n")
+#-----------------------------------------------------------------------------------------------------------
+    def _serve_client(self,conn,peer,protocol):
+        client = Proxy_Client("%s:%d %s" % (peer[0],peer[1],protocol))
+        with self._lock:
+            self.clients[client.name] = client
+            self._connections.add(conn)
+        logging.info("proxy: client %s connected" % client.name)
+        try:
+            if protocol == "json":
+                self._serve_json(conn,client)
+            else:
+                self._serve_prologix(conn,client)
+        except Exception as e:
+            logging.warning("proxy: client %s: %s" % (client.name,e))
+        finally:
+            conn.close()
+            with self._lock:
+                self.clients.pop(client.name,None)
+                self._connections.discard(conn)
+            logging.info("proxy: client %s disconnected" % client.name)
+#-----------------------------------------------------------------------------------------------------------
+    def serve(self,host="127.0.0.1",port=PROLOGIX_PORT,protocol="prologix"):
+        """
+        accept the clients of protocol ("prologix" or "json") on host:port (0 for any free port)
+        and return the port
+        """
+        if protocol not in ("prologix","json"):
+            raise Exception("protocol can only be prologix or json but %s found" % protocol)
+        server = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        server.bind((host,port))
+        server.listen()
+        self._servers.append(server)
+
+        def accept():
+            while self._running:
+                try:
+                    conn,peer = server.accept()
+                except OSError:
+                    return
+                conn.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+                threading.Thread(target=self._serve_client,args=(conn,peer,protocol),daemon=True).start()
+
+        threading.Thread(target=accept,name="prologix-proxy-%s" % protocol,daemon=True).start()
+        return server.getsockname()[1]
+#-----------------------------------------------------------------------------------------------------------
+    def stop(self):
+        self._running = False
+        for server in self._servers:
+            server.close()
+        self._servers = []
+        with self._lock:
+            connections = list(self._connections)
+        for conn in connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.scheduler.close()
+        self.device.close()
+
+#===========================================================================================================
+
+
+if __name__=="__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="share a Prologix controller between many clients")
+    parser.add_argument("device",choices=["usb","tcp"],help="type of connection to the prologix")
+    parser.add_argument("-s","--serial_number",help="Serial number (only for serial)",default=None)
+    parser.add_argument("-b","--baudrate",help="baudrate (only for serial)",type=int,default=9600)
+    parser.add_argument("-i","--ip",help="IP address of the device (only for tcp)",default=None)
+    parser.add_argument("--host",help="address the proxy listens on",default="127.0.0.1")
+    parser.add_argument("-p","--port",help="port of the prologix protocol",type=int,default=PROLOGIX_PORT)
+    parser.add_argument("--json_port",help="port of the json protocol",type=int,default=None)
+    parser.add_argument("--metrics",help="print the metrics every this many seconds",type=float,default=0)
+    args = parser.parse_args()
+
+    p = Prologix_Device(dev=args.device,ip=args.ip,serial_number=args.serial_number,baudrate=args.baudrate)
+    proxy = Prologix_Proxy(p)
+    print("Proxy on %s:%d" % (args.host,proxy.serve(args.host,args.port)))
+    if args.json_port is not None:
+        print("json requests on %s:%d" % (args.host,proxy.serve(args.host,args.json_port,"json")))
+    print("Ctrl-C to quit")
+    try:
+        while True:
+            time.sleep(args.metrics or 1)
+            if args.metrics:
+                print(json.dumps(proxy.metrics()))
+    except KeyboardInterrupt:
+        proxy.stop()
+    print("Bye !!")
@@ -0,0 +1,176 @@
+import os
+import sys
+import mmap
+import time
+import struct
+
+from prologix import MAX_READ_SIZE, TIMEOUT
+
+# recording and replay of the byte exchanges between Prologix_Device and its transport. A recorded
+# session is an append-only binary log: a header with the magic and the start time of the session,
+# then one record per call of the transport, a little endian (seconds since the start, direction,
+# length) followed by the bytes written or read. The reads that timed out are kept as empty records.
+#
+# usage:
+#     p = Prologix_Device(dev="tcp", ip="10.0.0.12", record="session.plx")
+#     ...
+#     p = Prologix_Device(dev="replay", replay="session.plx")             # as fast as possible
+#     p = Prologix_Device(dev="replay", replay="session.plx", speed=1.)   # at the original timing
+#
+#     python prologix_record.py session.plx                               # dump the log
+
+RECORD_MAGIC = b"PLXREC1\n"
+# time of the start of the session (time.time())
+RECORD_HEADER = struct.Struct("<8sd")
+# seconds since the start, direction (b"W" or b"R"), length of the data
+RECORD = struct.Struct("<dcI")
+WRITE = b"W"
+READ = b"R"
+
+class Replay_Mismatch(Exception):
+    pass
+
+#-----------------------------------------------------------------------------------------------------------
+def read_log(path):
+    """
+    return the start time of the session in the log and the list of its records
+    (seconds since the start, direction, data). The data are memoryviews on the memory mapped file.
+    """
+    with open(path,"rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < RECORD_HEADER.size:
+            raise Exception("%s is not a prologix session log" % path)
+        mm = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+    magic,start = RECORD_HEADER.unpack_from(mm,0)
+    if magic != RECORD_MAGIC:
+        raise Exception("%s is not a prologix session log" % path)
+    view = memoryview(mm)
+    records = []
+    offset = RECORD_HEADER.size
+    while offset + RECORD.size <= size:
+        t,direction,length = RECORD.unpack_from(mm,offset)
+        offset += RECORD.size
+        if offset + length > size:
+            # the last record was cut, e.g. by a crash during the recording
+            break
+        records.append((t,direction,view[offset:offset+length]))
+        offset += length
+    return start,records
+
+# the transport wrapper recording the exchanges of the transport device into the log at path
+#===========================================================================================================
+class recording_device():
+    def __init__(self,device,path):
+        self.device = device
+        self.path = path
+        self.start = time.monotonic()
+        self.log = open(path,"ab")
+        if self.log.tell() == 0:
+            self.log.write(RECORD_HEADER.pack(RECORD_MAGIC,time.time()))
+        else:
+            # a new session appended to an old log keeps counting from its start
+            start,records = read_log(path)
+            if records:
+                self.start -= records[-1][0]
+        self.log.flush()
+#-----------------------------------------------------------------------------------------------------------
+    def __getattr__(self,name):
+        # health(), stats... are the ones of the transport
+        return getattr(self.device,name)
+#-----------------------------------------------------------------------------------------------------------
+    def _record(self,direction,data):
+        self.log.write(RECORD.pack(time.monotonic()-self.start,direction,len(data)))
+        self.log.write(data)
+        self.log.flush()
+#-----------------------------------------------------------------------------------------------------------
+    def write(self,msg):
+        self._record(WRITE,msg)
+        self.device.write(msg)
+#-----------------------------------------------------------------------------------------------------------
+    def read(self,n):
+        data = self.device.read(n)
+        self._record(READ,data)
+        return data
+#-----------------------------------------------------------------------------------------------------------
+    def read_until(self,terminator,size=MAX_READ_SIZE,timeout=None):
+        data = self.device.read_until(terminator,size,timeout)
+        self._record(READ,data)
+        return data
+#-----------------------------------------------------------------------------------------------------------
+    def read_into(self,view,timeout=None):
+        n = self.device.read_into(view,timeout)
+        self._record(READ,memoryview(view).cast("B")[:n])
+        return n
+#-----------------------------------------------------------------------------------------------------------
+    def close(self):
+        if not self.log.closed:
+            self.log.close()
+        self.device.close()
+
+# the transport serving a recorded session back. The writes are checked against the recorded ones
+# and each read returns the next recorded reply, as fast as possible (speed None) or at the original
+# timing divided by speed.
+#===========================================================================================================
+class replay_device():
+    def __init__(self,path,speed=None,timeout=TIMEOUT):
+        self.path = path
+        self.speed = speed
+        self.timeout = timeout
+        self.session_start,self.records = read_log(path)
+        self.position = 0
+        self.start = time.monotonic()
+#-----------------------------------------------------------------------------------------------------------
+    def _next(self,direction):
+        if self.position >= len(self.records):
+            raise Replay_Mismatch("end of the session %s" % self.path)
+        t,d,data = self.records[self.position]
+        if d != direction:
+            raise Replay_Mismatch("record %d of %s is a %s not a %s" % (self.position,self.path,
+                                                                          d.decode(),direction.decode()))
+        self.position += 1
+        if self.speed:
+            wait = self.start + t/self.speed - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+        return data
+#-----------------------------------------------------------------------------------------------------------
+    def write(self,msg):
+        data = self._next(WRITE)
+        if data != msg:
+            raise Replay_Mismatch("record %d of %s: %r written but %r recorded" % (self.position-1,self.path,
+                                                                                   msg,bytes(data)))
+#-----------------------------------------------------------------------------------------------------------
+    def read(self,n):
+        return bytes(self._next(READ))
+#-----------------------------------------------------------------------------------------------------------
+    def read_until(self,terminator,size=MAX_READ_SIZE,timeout=None):
+        return bytes(self._next(READ))
+#-----------------------------------------------------------------------------------------------------------
+    def read_into(self,view,timeout=None):
+        data = self._next(READ)
+        view = memoryview(view).cast("B")
+        n = min(len(data),len(view))
+        view[:n] = data[:n]
+        return n
+#-----------------------------------------------------------------------------------------------------------
+    def rewind(self):
+        self.position = 0
+        self.start = time.monotonic()
+#-----------------------------------------------------------------------------------------------------------
+    def close(self):
+        pass
+
+#===========================================================================================================
+
+
+if __name__=="__main__":
+
+    if len(sys.argv) != 2:
+        print("usage: python prologix_record.py session.plx")
+        sys.exit(1)
+
+    start,records = read_log(sys.argv[1])
+    print("session started %s, %d records" % (time.strftime("%Y-%m-%d %H:%M:%S",time.localtime(start)),
+                                              len(records)))
+    for t,direction,data in records:
+        print("%12.6f %s %6d %r" % (t,direction.decode(),len(data),bytes(data[:80])))
@@ -0,0 +1,339 @@
+import os
+import time
+import socket
+import functools
+import logging
+import threading
+
+from prologix import PROLOGIX_PORT, RQS, help_usage, to_bytes
+
+# a simulator of the Prologix controllers with fake instruments on its GPIB bus. It serves the ++
+# commands on a local tcp port and on a pseudo terminal so that tcp_device and serial_device can
+# connect to it like to the real hardware:
+#
+#     sim = Prologix_Simulator()
+#     sim.add_instrument(12,Fake_Instrument({"*IDN?" : "FAKE,DMM,0,1.0", "READ?" : "+1.2345E+00"},
+#                                           latency=0.002))
+#     port = sim.serve_tcp()
+#     p = Prologix_Device(dev="tcp",ip="127.0.0.1",port=port)
+#
+#     path = sim.serve_pty()
+#     p = Prologix_Device(dev="usb",serial_port=path)
+
+SIM_VERSION = "Prologix GPIB-ETHERNET Controller version 01.06.06.00 (simulator)"
+
+# the settings of the controller and their values after ++rst
+DEFAULT_SETTINGS = {"addr" : (0,None),
+                    "auto" : 0,
+                    "eoi" : 1,
+                    "eos" : 0,
+                    "eot_enable" : 0,
+                    "eot_char" : 0,
+                    "lon" : 0,
+                    "mode" : 1,
+                    "read_tmo_ms" : 500,
+                    "savecfg" : 1,
+                    "status" : 0}
+
+#-----------------------------------------------------------------------------------------------------------
+def binary_block(data):
+    """
+    return data as an IEEE 488.2 definite length block #<n><length><data>
+    """
+    data = bytes(data)
+    length = b"%d" % len(data)
+    return b"#%d%s%s" % (len(length),length,data)
+
+# an instrument of the simulated bus
+#===========================================================================================================
+class Fake_Instrument():
+    def __init__(self,responses=None,latency=0.,terminator="\n",status=0,srq_commands=None):
+        """
+        responses maps the commands (case insensitive) to the replies, given as bytes, str or a
+        function of the command returning one of them. latency is the time the instrument takes
+        before its reply is available. srq_commands maps commands to the delay after which the
+        instrument requests service once it received them.
+        """
+        self.responses = {}
+        for cmd,reply in (responses or {}).items():
+            self.responses[to_bytes(cmd).strip().upper()] = reply
+        self.srq_commands = {}
+        for cmd,delay in (srq_commands or {}).items():
+            self.srq_commands[to_bytes(cmd).strip().upper()] = delay
+        self.latency = latency
+        self.terminator = to_bytes(terminator)
+        self.status = status
+        # the commands received, in order
+        self.received = []
+        self.output = b""
+        self.ready_at = 0.
+#-----------------------------------------------------------------------------------------------------------
+    def srq(self):
+        return bool(self.status & RQS)
+#-----------------------------------------------------------------------------------------------------------
+    def request_service(self,status=0):
+        self.status |= status | RQS
+#-----------------------------------------------------------------------------------------------------------
+    def serial_poll(self):
+        status = self.status
+        self.status &= ~RQS
+        return status
+#-----------------------------------------------------------------------------------------------------------
+    def clear(self):
+        self.output = b""
+#-----------------------------------------------------------------------------------------------------------
+    def write(self,cmd):
+        cmd = cmd.strip()
+        self.received.append(cmd)
+        key = cmd.upper()
+        if key == b"*CLS":
+            self.status = 0
+
+        reply = self.responses.get(key)
+        if reply is not None:
+            if callable(reply):
+                reply = reply(cmd)
+            self.output = to_bytes(reply) + self.terminator
+            self.ready_at = time.monotonic() + self.latency
+
+        if key in self.srq_commands:
+            timer = threading.Timer(self.srq_commands[key],self.request_service)
+            timer.daemon = True
+            timer.start()
+#-----------------------------------------------------------------------------------------------------------
+    def read(self,until=None):
+        """
+        return the output of the instrument (up to the byte until if given) once its latency has
+        passed, or b"" if it has nothing to say
+        """
+        if not self.output:
+            return b""
+        wait = self.ready_at - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        end = len(self.output)
+        if until is not None and until in self.output:
+            end = self.output.index(until) + 1
+        out = self.output[:end]
+        self.output = self.output[end:]
+        return out
+
+# the controller
+#===========================================================================================================
+class Prologix_Simulator():
+    def __init__(self,version=SIM_VERSION):
+        self.version = version
+        # (primary, secondary) -> Fake_Instrument
+        self.instruments = {}
+        self.settings = dict(DEFAULT_SETTINGS)
+        # the bus is shared by all the connections
+        self.lock = threading.Lock()
+        self._servers = []
+        self._running = True
+#-----------------------------------------------------------------------------------------------------------
+    def add_instrument(self,address,instrument,secondary=None):
+        self.instruments[(address,secondary)] = instrument
+        return instrument
+#-----------------------------------------------------------------------------------------------------------
+    def addressed(self):
+        return self.instruments.get(self.settings["addr"])
+#-----------------------------------------------------------------------------------------------------------
+    def _timeout(self):
+        # what the controller does when nobody answers
+        time.sleep(self.settings["read_tmo_ms"]/1000.)
+        return b""
+#-----------------------------------------------------------------------------------------------------------
+    def _talk(self,instrument,until=None):
+        out = instrument.read(until) if instrument is not None else b""
+        if not out:
+            return self._timeout()
+        if self.settings["eot_enable"] and (until is None or not out.endswith(until)):
+            out += bytes([self.settings["eot_char"]])
+        return out
+#-----------------------------------------------------------------------------------------------------------
+    def handle(self,line):
+        """
+        process one line received from the host and return the bytes to send back
+        """
+        line = line.rstrip(b"\r")
+        if line.startswith(b"++"):
+            return self.command(line)
+
+        # ESC protects the CR, LF, ESC and + of the data
+        data = bytearray()
+        escaped = False
+        for c in line:
+            if c == 27 and not escaped:
+                escaped = True
+                continue
+            escaped = False
+            data.append(c)
+
+        instrument = self.addressed()
+        if instrument is None:
+            return b""
+        instrument.write(bytes(data))
+        if self.settings["auto"]:
+            return self._talk(instrument)
+        return b""
+#-----------------------------------------------------------------------------------------------------------
+    def command(self,line):
+        words = line[2:].decode(errors="replace").split()
+        if not words:
+            return b"Unrecognized command\r\n"
+        name = words[0].lower()
+        args = words[1:]
+        try:
+            args = [int(a) for a in args] if name != "read" else args
+        except ValueError:
+            return b"Unrecognized command\r\n"
+
+        if name == "addr":
+            if not args:
+                return b"%s\r\n" % " ".join(["%d" % a for a in self.settings["addr"] if a is not None]).encode()
+            self.settings["addr"] = (args[0],args[1] if len(args) > 1 else None)
+        elif name in self.settings:
+            if not args:
+                return b"%d\r\n" % self.settings[name]
+            self.settings[name] = args[0]
+        elif name == "read":
+            until = None
+            if args and args[0].lower() != "eoi":
+                until = bytes([int(args[0])])
+            return self._talk(self.addressed(),until)
+        elif name == "spoll":
+            instrument = self.addressed() if not args else self.instruments.get((args[0],args[1] if len(args) > 1 else None))
+            if instrument is None:
+                return self._timeout()
+            return b"%d\r\n" % instrument.serial_poll()
+        elif name == "srq":
+            return b"%d\r\n" % any([i.srq() for i in self.instruments.values()])
+        elif name == "clr":
+            if self.addressed() is not None:
+                self.addressed().clear()
+        elif name == "trg":
+            if self.addressed() is not None:
+                self.addressed().write(b"*TRG")
+        elif name == "rst":
+            self.settings = dict(DEFAULT_SETTINGS)
+        elif name == "ver":
+            return b"%s\r\n" % self.version.encode()
+        elif name == "help":
+            return help_usage.strip("\n").replace("\n","\r\n").encode() + b"\r\n"
+        elif name not in ("ifc","loc"):
+            return b"Unrecognized command\r\n"
+        return b""
+#-----------------------------------------------------------------------------------------------------------
+    def _serve(self,recv,send):
+        buf = b""
+        while self._running:
+            try:
+                data = recv()
+            except OSError:
+                break
+            if not data:
+                break
+            buf += data
+            while b"\n" in buf:
+                line,buf = buf.split(b"\n",1)
+                with self.lock:
+                    reply = self.handle(line)
+                if reply:
+                    send(reply)
+#-----------------------------------------------------------------------------------------------------------
+    def serve_tcp(self,host="127.0.0.1",port=0):
+        """
+        serve the controller on a tcp port (0 for any free port) and return the port
+        """
+        server = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        server.bind((host,port))
+        server.listen()
+        self._servers.append(server)
+
+        def accept():
+            while self._running:
+                try:
+                    conn,peer = server.accept()
+                except OSError:
+                    return
+                conn.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+                logging.info("simulator: connection from %s:%d" % peer)
+                # each session thread keeps its own connection
+                threading.Thread(target=self._serve,args=(functools.partial(conn.recv,4096),conn.sendall),
+                                 daemon=True).start()
+
+        threading.Thread(target=accept,name="prologix-sim-tcp",daemon=True).start()
+        return server.getsockname()[1]
+#-----------------------------------------------------------------------------------------------------------
+    def serve_pty(self):
+        """
+        serve the controller on a pseudo terminal and return the path of its slave side
+        """
+        import pty,tty
+
+        master,slave = pty.openpty()
+        tty.setraw(slave)
+        self._servers.append(master)
+
+        def send(data):
+            while data:
+                data = data[os.write(master,data):]
+
+        threading.Thread(target=self._serve,args=(lambda: os.read(master,4096),send),
+                         name="prologix-sim-pty",daemon=True).start()
+        return os.ttyname(slave)
+#-----------------------------------------------------------------------------------------------------------
+    def stop(self):
+        self._running = False
+        for server in self._servers:
+            if isinstance(server,int):
+                os.close(server)
+            else:
+                server.close()
+        self._servers = []
+
+#-----------------------------------------------------------------------------------------------------------
+def demo_simulator():
+    """
+    return a simulator with a few instruments: a DMM at 12, a scope at 5 and a slow power supply
+    at 22 (secondary address 96)
+    """
+    import random
+    sim = Prologix_Simulator()
+    sim.add_instrument(12,Fake_Instrument({"*IDN?" : "FAKE,DMM,0,1.0",
+                                           "READ?" : lambda c: "%+.6E" % random.gauss(1.,1e-3)},
+                                          latency=0.001,
+                                          srq_commands={"INIT" : 0.05}))
+    sim.add_instrument(5,Fake_Instrument({"*IDN?" : "FAKE,SCOPE,0,1.0",
+                                          "CURV?" : binary_block(bytes(range(256))*1000)},
+                                         latency=0.005))
+    sim.add_instrument(22,Fake_Instrument({"*IDN?" : "FAKE,PSU,0,1.0",
+                                           "MEAS:VOLT?" : "12.000"},
+                                          latency=0.05),
+                       secondary=96)
+    return sim
+
+#===========================================================================================================
+
+
+if __name__=="__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Prologix controller simulator with a few fake instruments")
+    parser.add_argument("-p","--port",help="tcp port",type=int,default=PROLOGIX_PORT)
+    parser.add_argument("--pty",help="serve also on a pseudo terminal",action="store_true")
+    args = parser.parse_args()
+
+    sim = demo_simulator()
+    print("Simulator on tcp port %d" % sim.serve_tcp(host="0.0.0.0",port=args.port))
+    if args.pty:
+        print("Simulator on %s" % sim.serve_pty())
+    print("Ctrl-C to quit")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sim.stop()
+    print("Bye !!")
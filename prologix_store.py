@@ -0,0 +1,234 @@
+import os
+import json
+import time
+import threading
+
+from prologix import to_bytes
+
+SEGMENT_SIZE=1<<20      # rows per .npy segment
+INDEX_FILE="index.json"
+
+# a measurement store of the replies of the instruments. The values are kept in typed columns
+# (timestamp, controller, address, channel, value) in .npy segments of SEGMENT_SIZE rows, written
+# through memory maps, and a small json index gives the time range of each segment so that a time
+# range read only maps the segments it needs. The replies are parsed by batches with numpy: a
+# number, a list of numbers separated by commas (one channel per value) or a binary block.
+# numpy is only needed by this module.
+#
+# usage:
+#     store = Measurement_Store("run_2024_05_01")
+#     store.append_replies("rack1","12",dmm.query_many(["READ?"]*100))
+#     for batch in stream.batches():
+#         store.append_batch("rack1","12",batch)
+#     store.append_block("rack1","5",scope.query_binary("CURV?",dtype="i1"))
+#     data = store.read(t0=time.time()-3600)
+#     store.close()
+
+# the address column holds primary | secondary << 8
+def encode_address(address):
+    if isinstance(address,int):
+        return address
+    words = str(address).split()
+    if len(words) > 1:
+        return int(words[0]) | int(words[1]) << 8
+    return int(words[0])
+
+def decode_address(code):
+    code = int(code)
+    if code >> 8:
+        return "%d %d" % (code & 0xff,code >> 8)
+    return "%d" % code
+
+#===========================================================================================================
+class Measurement_Store():
+    def __init__(self,directory,segment_size=SEGMENT_SIZE):
+        import numpy as np
+        self.np = np
+        self.dtype = np.dtype([("timestamp","<f8"),
+                               ("controller","<u2"),
+                               ("address","<u2"),
+                               ("channel","<u4"),
+                               ("value","<f8")])
+        self.directory = directory
+        self.segment_size = segment_size
+        self._lock = threading.Lock()
+        os.makedirs(directory,exist_ok=True)
+
+        # segments: list of dicts file, rows, t_min, t_max
+        self.index = {"controllers" : [], "segments" : []}
+        path = os.path.join(directory,INDEX_FILE)
+        if os.path.exists(path):
+            with open(path) as f:
+                self.index = json.load(f)
+        self._segment = None
+#-----------------------------------------------------------------------------------------------------------
+    def controller_id(self,name):
+        controllers = self.index["controllers"]
+        if name not in controllers:
+            controllers.append(name)
+        return controllers.index(name)
+#-----------------------------------------------------------------------------------------------------------
+    def _open_segment(self):
+        # the last segment is reopened if it is not full
+        np = self.np
+        segments = self.index["segments"]
+        if segments and segments[-1]["rows"] < self.segment_size:
+            info = segments[-1]
+            self._segment = np.load(os.path.join(self.directory,info["file"]),mmap_mode="r+")
+            if len(self._segment) == self.segment_size:
+                return info
+            self._segment = None
+        info = {"file" : "segment_%06d.npy" % len(segments), "rows" : 0, "t_min" : None, "t_max" : None}
+        self._segment = np.lib.format.open_memmap(os.path.join(self.directory,info["file"]),mode="w+",
+                                                  dtype=self.dtype,shape=(self.segment_size,))
+        segments.append(info)
+        return info
+#-----------------------------------------------------------------------------------------------------------
+    def append(self,controller,address,timestamps,values,channels=0):
+        """
+        append the values with their timestamps and channels (arrays or scalars broadcast to the
+        length of values) for the instrument at address of controller
+        """
+        np = self.np
+        values = np.asarray(values,dtype=np.float64).ravel()
+        n = len(values)
+        if n == 0:
+            return
+        rows = np.empty(n,dtype=self.dtype)
+        rows["timestamp"] = timestamps
+        rows["channel"] = channels
+        rows["value"] = values
+        rows["address"] = encode_address(address)
+
+        with self._lock:
+            rows["controller"] = self.controller_id(controller)
+            done = 0
+            while done < n:
+                info = self.index["segments"][-1] if self._segment is not None else self._open_segment()
+                start = info["rows"]
+                if start == self.segment_size:
+                    self._segment.flush()
+                    self._segment = None
+                    self.save_index()
+                    continue
+                k = min(n-done,self.segment_size-start)
+                chunk = rows[done:done+k]
+                self._segment[start:start+k] = chunk
+                t_min = float(chunk["timestamp"].min())
+                t_max = float(chunk["timestamp"].max())
+                info["t_min"] = t_min if info["t_min"] is None else min(info["t_min"],t_min)
+                info["t_max"] = t_max if info["t_max"] is None else max(info["t_max"],t_max)
+                info["rows"] = start + k
+                done += k
+#-----------------------------------------------------------------------------------------------------------
+    def append_replies(self,controller,address,replies,timestamps=None):
+        """
+        parse the text replies, numbers or lists of numbers separated by commas, and append them.
+        The values of a list get the channels 0, 1, ... and the empty ones are stored as NaN.
+        timestamps defaults to now for all of them.
+        """
+        np = self.np
+        replies = [to_bytes(r).strip() for r in replies]
+        if not replies:
+            return
+        if timestamps is None:
+            timestamps = time.time()
+        counts = np.char.count(np.array(replies),b",") + 1
+        # an empty reply or value (e.g. a query that timed out) is stored as NaN
+        values = np.array([v or b"nan" for v in b",".join(replies).split(b",")],dtype=np.float64)
+        # the channel is the position of the value in its reply
+        starts = np.repeat(np.cumsum(counts) - counts,counts)
+        channels = np.arange(len(values)) - starts
+        self.append(controller,address,np.repeat(np.broadcast_to(timestamps,len(replies)),counts),
+                    values,channels)
+#-----------------------------------------------------------------------------------------------------------
+    def append_batch(self,controller,address,batch):
+        """
+        append a batch of (time, value) samples of Prologix_Stream, the values being the parsed
+        numbers (float or list) or the raw replies
+        """
+        if not batch:
+            return
+        if isinstance(batch[0][1],(bytes,bytearray,str)):
+            self.append_replies(controller,address,[v for t,v in batch],[t for t,v in batch])
+            return
+        np = self.np
+        counts = np.array([len(v) if isinstance(v,(list,tuple)) else 1 for t,v in batch])
+        values = []
+        for t,v in batch:
+            if isinstance(v,(list,tuple)):
+                values.extend(v)
+            else:
+                values.append(v)
+        starts = np.repeat(np.cumsum(counts) - counts,counts)
+        self.append(controller,address,np.repeat([t for t,v in batch],counts),values,
+                    np.arange(len(values)) - starts)
+#-----------------------------------------------------------------------------------------------------------
+    def append_block(self,controller,address,values,timestamp=None):
+        """
+        append the values of a binary block (e.g. query_binary with a dtype), the channel being
+        the position in the block
+        """
+        np = self.np
+        values = np.asarray(values).ravel()
+        self.append(controller,address,time.time() if timestamp is None else timestamp,values,
+                    np.arange(len(values)))
+#-----------------------------------------------------------------------------------------------------------
+    def read(self,t0=None,t1=None,controller=None,address=None):
+        """
+        return the rows with t0 <= timestamp < t1, of controller and address if given, as a numpy
+        structured array. Only the segments that overlap the time range are read.
+        """
+        np = self.np
+        with self._lock:
+            if self._segment is not None:
+                self._segment.flush()
+            segments = [dict(s) for s in self.index["segments"]]
+            controllers = list(self.index["controllers"])
+        if controller is not None and controller not in controllers:
+            return np.empty(0,dtype=self.dtype)
+        parts = []
+        for info in segments:
+            if info["rows"] == 0:
+                continue
+            if t0 is not None and info["t_max"] < t0:
+                continue
+            if t1 is not None and info["t_min"] >= t1:
+                continue
+            rows = np.load(os.path.join(self.directory,info["file"]),mmap_mode="r")[:info["rows"]]
+            mask = np.ones(len(rows),dtype=bool)
+            if t0 is not None:
+                mask &= rows["timestamp"] >= t0
+            if t1 is not None:
+                mask &= rows["timestamp"] < t1
+            if controller is not None:
+                mask &= rows["controller"] == controllers.index(controller)
+            if address is not None:
+                mask &= rows["address"] == encode_address(address)
+            parts.append(rows[mask])
+        if not parts:
+            return np.empty(0,dtype=self.dtype)
+        return np.concatenate(parts)
+#-----------------------------------------------------------------------------------------------------------
+    def save_index(self):
+        path = os.path.join(self.directory,INDEX_FILE)
+        with open(path + ".tmp","w") as f:
+            json.dump(self.index,f,indent=1)
+        os.replace(path + ".tmp",path)
+#-----------------------------------------------------------------------------------------------------------
+    def flush(self):
+        with self._lock:
+            if self._segment is not None:
+                self._segment.flush()
+            self.save_index()
+#-----------------------------------------------------------------------------------------------------------
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._segment = None
+#-----------------------------------------------------------------------------------------------------------
+    def __enter__(self):
+        return self
+#-----------------------------------------------------------------------------------------------------------
+    def __exit__(self,*exc):
+        self.close()
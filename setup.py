@@ -4,7 +4,7 @@ from setuptools import setup
 setup(
     name = 'prologix',
     version = '1.0',
-    py_modules = ['prologix'],
+    py_modules = ['prologix', 'prologix_async', 'prologix_pool', 'prologix_sim', 'prologix_record', 'prologix_store', 'prologix_proxy', 'netfinder', 'prologix_index'],
     install_requires=[
         'pyserial',
     ],